@@ -0,0 +1,874 @@
+#!/usr/bin/env python3
+"""Lasttest für den Mail-Empfang
+
+Startet einen minimalen IMAP-Server und einen nachgebauten LexOffice-Dienst auf
+localhost, füllt das Postfach mit synthetischen Mails und lässt den echten
+ImapReceiver (bzw. AsyncReceiverPool) in einem Kindprozess dagegen laufen.
+Am Ende werden Durchsatz, Latenz (Einlieferung bis letzte Änderung am Server)
+und der Spitzen-Speicherbedarf des Empfängers ausgegeben.
+
+Beispiel:
+	python contrib/loadtest.py -n 500 --latency 0.05 --error-rate 0.01 --upload-workers 4 --partial-fetch
+"""
+
+import argparse
+import datetime
+import email.mime.application
+import email.mime.image
+import email.mime.multipart
+import email.mime.text
+import email.policy
+import email.utils
+import http.cookies
+import http.server
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shlex
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexofficetools.config import ConfigurationManager, Configuration, CONFIG_DEFAULTS
+from lexofficetools.mail import ImapReceiver
+from lexofficetools.aiomail import AsyncReceiverPool
+from lexofficetools.state import Outbox
+
+SENDER = "belege@example.com"
+FOREIGN_SENDER = "spam@example.org"
+RECIPIENT = "buchhaltung@example.com"
+USERNAME = "loadtest"
+PASSWORD = "loadtest"
+CONFIG_NAME = "loadtest"
+
+## Anteil der Mailarten an der Gesamtmenge
+MAIL_KINDS = [
+	("pdf", 30),
+	("jpeg", 15),
+	("png", 10),
+	("zip", 10),
+	("octet", 10),
+	("multi", 10),
+	("junk", 10),
+	("foreign", 5),
+]
+
+SEEN = "\\Seen"
+DELETED = "\\Deleted"
+
+logger = logging.getLogger('loadtest')
+
+
+class ImapMessage(object):
+	def __init__(self, uid, data):
+		self.uid = uid
+		self.data = data
+		self.flags = set()
+		self.message = email.message_from_bytes(data)
+
+	def header(self):
+		for separator in (b"\r\n\r\n", b"\n\n"):
+			if separator in self.data:
+				return self.data.split(separator, 1)[0] + separator
+		return self.data
+
+	def part(self, section):
+		part = self.message
+		for index in section.split("."):
+			index = int(index)
+			if part.is_multipart():
+				part = part.get_payload()[index-1]
+			elif index != 1:
+				return None
+		return part
+
+	def section(self, section):
+		if section == "HEADER":
+			return self.header()
+
+		mime = section.endswith(".MIME")
+		if mime:
+			section = section[:-5]
+
+		part = self.part(section)
+		if part is None:
+			return b""
+
+		if mime:
+			return "".join("{0}: {1}\r\n".format(k, v) for k, v in part.items()).encode("utf-8") + b"\r\n"
+
+		return raw_payload(part)
+
+
+def raw_payload(part):
+	payload = part.get_payload()
+	if isinstance(payload, list):
+		return b"".join(raw_payload(p) for p in payload)
+	return payload.encode("utf-8", "surrogateescape")
+
+def quote(value):
+	if value is None:
+		return "NIL"
+	return '"{0}"'.format(str(value).replace("\\", "\\\\").replace('"', '\\"'))
+
+def param_list(params):
+	if not params:
+		return "NIL"
+	return "({0})".format(" ".join("{0} {1}".format(quote(k), quote(v)) for k, v in params))
+
+def bodystructure(part):
+	params = [(k, v) for k, v in (part.get_params() or [])[1:]]
+
+	if part.is_multipart():
+		return "({0} {1} {2} NIL NIL)".format(
+			"".join(bodystructure(p) for p in part.get_payload()),
+			quote(part.get_content_subtype()),
+			param_list(params))
+
+	payload = raw_payload(part)
+	disposition = "NIL"
+	if part.get("Content-Disposition"):
+		value, dparams = part.get_params(header="Content-Disposition")[0][0], part.get_params(header="Content-Disposition")[1:]
+		disposition = "({0} {1})".format(quote(value), param_list(dparams))
+
+	fields = [
+		quote(part.get_content_maintype()),
+		quote(part.get_content_subtype()),
+		param_list(params),
+		"NIL",
+		"NIL",
+		quote(part.get("Content-Transfer-Encoding", "7bit")),
+		str(len(payload)),
+	]
+	if part.get_content_maintype() == "text":
+		fields.append(str(payload.count(b"\n")))
+	fields.extend(["NIL", disposition, "NIL"])
+
+	return "({0})".format(" ".join(fields))
+
+def parse_sequence_set(value, maximum):
+	result = set()
+	for item in value.split(","):
+		if ":" in item:
+			start, end = item.split(":", 1)
+			start = maximum if start == "*" else int(start)
+			end = maximum if end == "*" else int(end)
+			result.update(range(min(start, end), max(start, end)+1))
+		else:
+			result.add(maximum if item == "*" else int(item))
+	return result
+
+def tokenize(line):
+	"""Zerlegt eine Kommandozeile, Klammern werden als eigene Tokens geliefert."""
+	lexer = shlex.shlex(line, posix=True)
+	lexer.whitespace_split = False
+	lexer.wordchars += ".:,*[]<>-+$/@!#%&'=^_`{|}~"
+	lexer.quotes = '"'
+	lexer.escape = '\\'
+	lexer.escapedquotes = '"'
+	return list(lexer)
+
+
+class ImapMailbox(object):
+	"""Gemeinsamer Zustand des IMAP-Servers: ein Benutzer, eine INBOX, beliebige Zielordner."""
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.inbox = []
+		self.folders = {"INBOX": None}
+		self.uidvalidity = int(time.time())
+		self.uidnext = 1
+		self.delivered_at = {}
+		self.touched_at = {}
+		self.moved = {}
+		self.connections = set()
+		self.idle_since = None
+
+	def deliver(self, data):
+		with self.lock:
+			message = ImapMessage(self.uidnext, data)
+			self.uidnext = self.uidnext + 1
+			self.inbox.append(message)
+			self.delivered_at[message.uid] = time.time()
+			exists = len(self.inbox)
+			connections = list(self.connections)
+
+		for connection in connections:
+			connection.notify_exists(exists)
+
+		return message.uid
+
+	def touch(self, uids):
+		now = time.time()
+		for uid in uids:
+			self.touched_at[uid] = now
+
+	def seqnum(self, message):
+		return self.inbox.index(message) + 1
+
+	def by_uid(self, uids):
+		return [message for message in self.inbox if message.uid in uids]
+
+	def remove(self, messages, folder=None):
+		"""Entfernt Mails aus der INBOX, liefert die EXPUNGE-Sequenznummern in Reihenfolge."""
+		result = []
+		for message in messages:
+			result.append(self.seqnum(message))
+			self.inbox.remove(message)
+			if folder is not None:
+				self.moved[message.uid] = folder
+		self.touch([message.uid for message in messages])
+		return result
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+	def setup(self):
+		super(ImapHandler, self).setup()
+		self.mailbox = self.server.mailbox
+		self.write_lock = threading.Lock()
+		self.idling = False
+		self.selected = False
+
+	def send(self, *lines):
+		with self.write_lock:
+			for line in lines:
+				if isinstance(line, str):
+					line = line.encode("utf-8")
+				self.wfile.write(line)
+			self.wfile.flush()
+
+	def notify_exists(self, exists):
+		if self.idling:
+			try:
+				self.send("* {0} EXISTS\r\n".format(exists))
+			except OSError:
+				pass
+
+	def handle(self):
+		self.send("* OK [CAPABILITY IMAP4rev1 IDLE MOVE UIDPLUS] Lasttest-IMAP bereit\r\n")
+		with self.mailbox.lock:
+			self.mailbox.connections.add(self)
+
+		try:
+			while True:
+				line = self.rfile.readline()
+				if not line:
+					break
+
+				line = line.decode("utf-8").rstrip("\r\n")
+				if not line:
+					continue
+
+				tag, _, rest = line.partition(" ")
+				command, _, args = rest.partition(" ")
+				command = command.upper()
+
+				if command == "LOGOUT":
+					self.send("* BYE Tschüss\r\n", "{0} OK LOGOUT completed\r\n".format(tag))
+					break
+
+				try:
+					self.dispatch(tag, command, args)
+				except OSError:
+					break
+				except Exception as e:
+					logger.exception("Fehler im IMAP-Kommando %r", line)
+					self.send("{0} BAD {1}\r\n".format(tag, e))
+		finally:
+			with self.mailbox.lock:
+				self.mailbox.connections.discard(self)
+
+	def dispatch(self, tag, command, args):
+		if command == "CAPABILITY":
+			self.send("* CAPABILITY IMAP4rev1 IDLE MOVE UIDPLUS\r\n")
+		elif command == "LOGIN":
+			username, password = tokenize(args)[:2]
+			if (username, password) != (USERNAME, PASSWORD):
+				self.send("{0} NO [AUTHENTICATIONFAILED] Falsche Zugangsdaten\r\n".format(tag))
+				return
+		elif command == "LIST":
+			reference, pattern = tokenize(args)[:2]
+			with self.mailbox.lock:
+				for folder in sorted(self.mailbox.folders):
+					if pattern in ("*", "%") or folder == pattern:
+						self.send('* LIST () "/" {0}\r\n'.format(quote(folder)))
+		elif command == "CREATE":
+			with self.mailbox.lock:
+				self.mailbox.folders.setdefault(tokenize(args)[0], [])
+		elif command in ("SUBSCRIBE", "NOOP", "ENABLE", "CHECK"):
+			pass
+		elif command in ("SELECT", "EXAMINE"):
+			with self.mailbox.lock:
+				self.selected = True
+				self.send(
+					"* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n",
+					"* {0} EXISTS\r\n".format(len(self.mailbox.inbox)),
+					"* 0 RECENT\r\n",
+					"* OK [UIDVALIDITY {0}] UIDs valid\r\n".format(self.mailbox.uidvalidity),
+					"* OK [UIDNEXT {0}] Predicted next UID\r\n".format(self.mailbox.uidnext),
+				)
+			self.send("{0} OK [READ-WRITE] {1} completed\r\n".format(tag, command))
+			return
+		elif command == "IDLE":
+			self.idling = True
+			self.mailbox.idle_since = time.time()
+			self.send("+ idling\r\n")
+			line = self.rfile.readline()
+			self.idling = False
+			self.mailbox.idle_since = None
+			if not line:
+				raise ConnectionError("Verbindung während IDLE geschlossen")
+		elif command == "EXPUNGE":
+			with self.mailbox.lock:
+				for seqnum in self.mailbox.remove([m for m in self.mailbox.inbox if DELETED in m.flags]):
+					self.send("* {0} EXPUNGE\r\n".format(seqnum))
+		elif command == "UID":
+			subcommand, _, args = args.partition(" ")
+			getattr(self, "uid_" + subcommand.lower())(args)
+		else:
+			self.send("{0} BAD Unbekanntes Kommando {1}\r\n".format(tag, command))
+			return
+
+		self.send("{0} OK {1} completed\r\n".format(tag, command))
+
+	def uid_set(self, value):
+		return parse_sequence_set(value, max(self.mailbox.uidnext-1, 1))
+
+	def uid_search(self, args):
+		tokens = [t.upper() for t in tokenize(args)]
+		with self.mailbox.lock:
+			result = [m.uid for m in self.mailbox.inbox if self.matches(m, list(tokens))]
+		self.send("* SEARCH {0}\r\n".format(" ".join(str(uid) for uid in result)).replace(" \r\n", "\r\n"))
+
+	def matches(self, message, tokens):
+		while tokens:
+			if not self.match_one(message, tokens):
+				return False
+		return True
+
+	def match_one(self, message, tokens):
+		token = tokens.pop(0)
+		if token == "NOT":
+			return not self.match_one(message, tokens)
+		elif token == "ALL":
+			return True
+		elif token in ("SEEN", "DELETED"):
+			return "\\" + token.capitalize() in message.flags
+		elif token in ("UNSEEN", "UNDELETED"):
+			return "\\" + token[2:].capitalize() not in message.flags
+		elif token == "UID":
+			return message.uid in self.uid_set(tokens.pop(0))
+		raise ValueError("Suchkriterium {0} nicht unterstützt".format(token))
+
+	def uid_fetch(self, args):
+		uids, _, items = args.partition(" ")
+		items = items.strip()
+		if items.startswith("(") and items.endswith(")"):
+			items = items[1:-1]
+		items = items.split()
+
+		with self.mailbox.lock:
+			messages = self.mailbox.by_uid(self.uid_set(uids))
+			for message in messages:
+				response = ["* {0} FETCH (UID {1}".format(self.mailbox.seqnum(message), message.uid).encode("utf-8")]
+				set_seen = False
+
+				for item in items:
+					item = item.upper()
+					if item == "UID":
+						continue
+					elif item == "FLAGS":
+						response.append(" FLAGS ({0})".format(" ".join(sorted(message.flags))).encode("utf-8"))
+					elif item == "BODYSTRUCTURE":
+						response.append(" BODYSTRUCTURE {0}".format(bodystructure(message.message)).encode("utf-8"))
+					elif item in ("RFC822", "BODY[]", "BODY.PEEK[]"):
+						response.append(" {0} {{{1}}}\r\n".format("RFC822" if item == "RFC822" else "BODY[]", len(message.data)).encode("utf-8") + message.data)
+						set_seen = set_seen or ".PEEK" not in item
+					elif item.startswith("BODY"):
+						section = re.match(r"BODY(?:\.PEEK)?\[(.*)\]", item).group(1)
+						data = message.section(section)
+						response.append(" BODY[{0}] {{{1}}}\r\n".format(section, len(data)).encode("utf-8") + data)
+						set_seen = set_seen or ".PEEK" not in item
+					else:
+						raise ValueError("FETCH-Element {0} nicht unterstützt".format(item))
+
+				if set_seen:
+					message.flags.add(SEEN)
+				self.send(b"".join(response) + b")\r\n")
+
+			self.mailbox.touch([message.uid for message in messages])
+
+	def uid_store(self, args):
+		uids, mode, flags = args.split(" ", 2)
+		flags = set(flags.strip("()").split())
+
+		with self.mailbox.lock:
+			messages = self.mailbox.by_uid(self.uid_set(uids))
+			for message in messages:
+				if mode.upper().startswith("+"):
+					message.flags.update(flags)
+				elif mode.upper().startswith("-"):
+					message.flags.difference_update(flags)
+				else:
+					message.flags = set(flags)
+
+				if not mode.upper().endswith(".SILENT"):
+					self.send("* {0} FETCH (UID {1} FLAGS ({2}))\r\n".format(self.mailbox.seqnum(message), message.uid, " ".join(sorted(message.flags))))
+
+			self.mailbox.touch([message.uid for message in messages])
+
+	def uid_copy(self, args, move=False):
+		uids, folder = args.split(" ", 1)
+		folder = tokenize(folder)[0]
+
+		with self.mailbox.lock:
+			if folder not in self.mailbox.folders:
+				raise ValueError("Ordner {0} existiert nicht".format(folder))
+
+			messages = self.mailbox.by_uid(self.uid_set(uids))
+			self.mailbox.folders[folder].extend(message.uid for message in messages)
+
+			if move:
+				for seqnum in self.mailbox.remove(messages, folder):
+					self.send("* {0} EXPUNGE\r\n".format(seqnum))
+			else:
+				for message in messages:
+					self.mailbox.moved[message.uid] = folder
+				self.mailbox.touch([message.uid for message in messages])
+
+	def uid_move(self, args):
+		self.uid_copy(args, move=True)
+
+	def uid_expunge(self, args):
+		with self.mailbox.lock:
+			messages = [m for m in self.mailbox.by_uid(self.uid_set(args.strip())) if DELETED in m.flags]
+			for seqnum in self.mailbox.remove(messages):
+				self.send("* {0} EXPUNGE\r\n".format(seqnum))
+
+
+class ImapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, mailbox):
+		self.mailbox = mailbox
+		socketserver.TCPServer.__init__(self, address, ImapHandler)
+
+
+class LexofficeHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	ROUTES = [
+		("POST", r"/grld-public/login/authorize$", "login"),
+		("GET", r"/grld-public/login/v100/logout$", "empty"),
+		("GET", r"/grld-rest/privilege-management/v100/privilege$", "empty"),
+		("POST", r"/grld-rest/voucherimageservice/1/v101/uploadBookkeepingVoucherImage/$", "upload"),
+		("POST", r"/grld-upload-rest/uploadNtService/v100/uploadCsvFile/$", "upload"),
+		("GET", r"/grld-rest/financialaccountservice/v100/financialAccounts$", "financial_accounts"),
+		("GET", r"/grld-rest/financialtransactionservice/v100/financialTransactions$", "financial_transactions"),
+		("PUT", r"/grld-rest/importprofileservice/v100/importprofile/financialAccount/[^/]+$", "import_profile"),
+		("POST", r"/grld-rest/financialtransactionimportservice/v100/import$", "start_import"),
+		("GET", r"/grld-rest/financialtransactionimportservice/v100/importState/[^/]+$", "import_state"),
+		("POST", r"/grld-rest/financialtransactionimportservice/v100/csvPreview$", "empty"),
+	]
+
+	def log_message(self, format, *args):
+		logger.debug(format, *args)
+
+	def do_GET(self):
+		self.route("GET")
+
+	def do_POST(self):
+		self.route("POST")
+
+	def do_PUT(self):
+		self.route("PUT")
+
+	def route(self, method):
+		url = urllib.parse.urlsplit(self.path)
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+
+		for route_method, pattern, name in self.ROUTES:
+			if route_method == method and re.search(pattern, url.path):
+				break
+		else:
+			return self.reply(404, {"error": "not found"})
+
+		service = self.server.service
+		service.count_second()
+		if service.latency:
+			time.sleep(random.expovariate(1.0/service.latency))
+
+		if service.error_rate and random.random() < service.error_rate:
+			service.count("errors")
+			return self.reply(503, {"error": "injected"})
+
+		if name == "login":
+			token = service.new_session()
+			return self.reply(200, self.api_login(None, body), {"Set-Cookie": "JSESSIONID={0}; Path=/".format(token)})
+
+		cookies = http.cookies.SimpleCookie(self.headers.get("Cookie", ""))
+		if "JSESSIONID" not in cookies or not service.check_session(cookies["JSESSIONID"].value):
+			service.count("unauthorized")
+			return self.reply(401, {"error": "unauthorized"})
+
+		self.reply(200, getattr(self, "api_" + name)(urllib.parse.parse_qs(url.query), body))
+
+	def reply(self, status, data, headers={}):
+		data = json.dumps(data).encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(data)
+
+	def api_login(self, query, body):
+		self.server.service.count("logins")
+		return {"status": "OK"}
+
+	def api_empty(self, query, body):
+		return {}
+
+	def api_upload(self, query, body):
+		self.server.service.count("uploads")
+		self.server.service.count("upload_bytes", len(body))
+		return {"id": str(uuid.uuid4())}
+
+	def api_financial_accounts(self, query, body):
+		return self.server.service.accounts
+
+	def api_financial_transactions(self, query, body):
+		first_row = int(query.get("firstRow", ["0"])[0])
+		num_rows = int(query.get("numRows", ["60"])[0])
+		account = query.get("financialAccountId", [None])[0]
+
+		transactions = [t for t in self.server.service.transactions if account is None or t["financialAccountId"] == account]
+		return transactions[first_row:first_row+num_rows]
+
+	def api_import_profile(self, query, body):
+		return {"statusType": "OK"}
+
+	def api_start_import(self, query, body):
+		service = self.server.service
+		service.count("imports")
+		import_id = str(uuid.uuid4())
+		with service.counter_lock:
+			service.imports[import_id] = time.time()
+		return {"status": "PENDING", "financialTransactionImportId": import_id}
+
+	def api_import_state(self, query, body):
+		service = self.server.service
+		service.count("import_polls")
+		import_id = urllib.parse.unquote(self.path.split("?")[0].rsplit("/", 1)[1])
+		with service.counter_lock:
+			started = service.imports.get(import_id)
+		if started is None:
+			return {"status": "FAILED"}
+		if time.time() - started < service.import_duration:
+			return {"status": "PENDING"}
+		return {"status": "DONE"}
+
+
+class LexofficeServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address, latency=0, error_rate=0, session_lifetime=0, import_duration=0, accounts=2, transactions=200):
+		self.latency = latency
+		self.error_rate = error_rate
+		self.session_lifetime = session_lifetime
+		self.import_duration = import_duration
+		self.imports = {}
+		self.sessions = {}
+		self.counters = {}
+		self.per_second = {}
+		self.counter_lock = threading.Lock()
+		self.service = self
+
+		self.accounts = [
+			{"financialAccountId": str(uuid.UUID(int=i+1)), "name": "Kreditkarte {0}".format(i+1), "type": "CREDITCARD"}
+			for i in range(accounts)
+		]
+		## Neueste zuerst, wie bei lexoffice
+		self.transactions = []
+		for i in range(transactions):
+			self.transactions.append({
+				"financialAccountId": self.accounts[i % accounts]["financialAccountId"] if accounts else None,
+				"purpose": "Umsatz {0} / Lasttest".format(i),
+				"amount": -round(random.uniform(1, 500), 2),
+				"dateLocalized": "{0:%d.%m.%Y}".format(datetime.date(2020, 12, 31) - datetime.timedelta(days=i // 2)),
+			})
+
+		http.server.ThreadingHTTPServer.__init__(self, address, LexofficeHandler)
+
+	def new_session(self):
+		token = uuid.uuid4().hex
+		with self.counter_lock:
+			self.sessions[token] = time.time()
+		return token
+
+	def check_session(self, token):
+		with self.counter_lock:
+			started = self.sessions.get(token)
+		if started is None:
+			return False
+		return not self.session_lifetime or time.time() - started < self.session_lifetime
+
+	def count_second(self):
+		with self.counter_lock:
+			second = int(time.time())
+			self.per_second[second] = self.per_second.get(second, 0) + 1
+
+	def count(self, name, amount=1):
+		with self.counter_lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+
+def random_bytes(rng, size):
+	return rng.getrandbits(8*size).to_bytes(size, "little") if size else b""
+
+def fake_pdf(rng, size):
+	return b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n" + random_bytes(rng, size) + b"\n%%EOF\n"
+
+def fake_jpeg(rng, size):
+	return b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00" + random_bytes(rng, size) + b"\xff\xd9"
+
+def fake_png(rng, size):
+	return b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x01\x00\x00\x00\x01\x00\x08\x02\x00\x00\x00" + random_bytes(rng, size)
+
+def fake_zip(rng, size, nested=True):
+	fp = io.BytesIO()
+	with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as zfile:
+		zfile.writestr("rechnung.pdf", fake_pdf(rng, size))
+		zfile.writestr("liesmich.txt", b"Bitte buchen.\n")
+		if nested:
+			zfile.writestr("belege.zip", fake_zip(rng, size // 2, nested=False))
+		else:
+			zfile.writestr("quittung.jpg", fake_jpeg(rng, size // 2))
+	return fp.getvalue()
+
+def attachment(data, maintype, subtype, filename):
+	if maintype == "image":
+		part = email.mime.image.MIMEImage(data, subtype)
+	else:
+		part = email.mime.application.MIMEApplication(data, subtype)
+	part.add_header("Content-Disposition", "attachment", filename=filename)
+	return part
+
+def generate_mail(rng, index, kind, size):
+	size = max(int(rng.uniform(0.5, 1.5) * size), 0)
+
+	message = email.mime.multipart.MIMEMultipart()
+	message["From"] = FOREIGN_SENDER if kind == "foreign" else SENDER
+	message["To"] = RECIPIENT
+	message["Subject"] = "Lasttest {0} ({1})".format(index, kind)
+	message["Message-ID"] = "<loadtest-{0}-{1}@example.com>".format(index, uuid.uuid4().hex)
+	message["Date"] = email.utils.formatdate()
+	message.attach(email.mime.text.MIMEText("Beleg Nummer {0}\n".format(index)))
+
+	if kind in ("pdf", "foreign"):
+		message.attach(attachment(fake_pdf(rng, size), "application", "pdf", "rechnung-{0}.pdf".format(index)))
+	elif kind == "jpeg":
+		message.attach(attachment(fake_jpeg(rng, size), "image", "jpeg", "foto-{0}.jpg".format(index)))
+	elif kind == "png":
+		message.attach(attachment(fake_png(rng, size), "image", "png", "scan-{0}.png".format(index)))
+	elif kind == "zip":
+		message.attach(attachment(fake_zip(rng, size), "application", "zip", "belege-{0}.zip".format(index)))
+	elif kind == "octet":
+		message.attach(attachment(fake_pdf(rng, size), "application", "octet-stream", "beleg-{0}.bin".format(index)))
+	elif kind == "multi":
+		for i in range(3):
+			message.attach(attachment(fake_pdf(rng, size // 3), "application", "pdf", "teil-{0}-{1}.pdf".format(index, i)))
+	elif kind == "junk":
+		message.attach(attachment(random_bytes(rng, min(size, 4096)), "application", "x-unknown", "daten-{0}.dat".format(index)))
+
+	return message.as_bytes(policy=email.policy.SMTP)
+
+def generate_mails(options):
+	rng = random.Random(options.seed)
+	kinds = [kind for kind, weight in MAIL_KINDS for i in range(weight)]
+	for index in range(options.messages):
+		yield generate_mail(rng, index, rng.choice(kinds), options.attachment_size * 1024)
+
+
+def receiver_configuration(options, imap_port, lexoffice_port):
+	imap = {
+		"server": "127.0.0.1",
+		"port": imap_port,
+		"ssl": False,
+		"username": USERNAME,
+		"password": PASSWORD,
+		"partial_fetch": options.partial_fetch,
+		"upload_workers": options.upload_workers,
+		"queue_size": options.queue_size,
+		"fetch_chunk_size": options.fetch_chunk_size,
+		"disposition_batch_size": options.disposition_batch_size,
+		"dedup": not options.no_dedup,
+		"incremental": options.incremental,
+		"outbox": options.outbox,
+	}
+
+	return {
+		"imap": imap,
+		"access": {"from": [SENDER]},
+		"lexofficeInstance": "127.0.0.1:{0}".format(lexoffice_port),
+		"lexofficeScheme": "http",
+		"lexoffice": {
+			"auth": {"username": USERNAME, "password": PASSWORD},
+			"rate_limit": options.rate_limit,
+			"retries": options.retries,
+		},
+	}
+
+def run_receiver(options, config):
+	logging.getLogger().setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+	logging.getLogger("requests.packages.urllib3").setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+
+	c = ConfigurationManager()
+	c.configs[CONFIG_NAME] = dict(CONFIG_DEFAULTS)
+	c.configs[CONFIG_NAME].update(config)
+
+	if options.receiver == "async":
+		AsyncReceiverPool(c.configurations(), max_workers=options.workers).run()
+	else:
+		ImapReceiver(Configuration(c, CONFIG_NAME)).run()
+
+def percentile(values, p):
+	if not values:
+		return float("nan")
+	values = sorted(values)
+	return values[min(len(values)-1, int(round(p / 100.0 * (len(values)-1))))]
+
+def is_finished(mailbox, options, total):
+	with mailbox.lock:
+		if len(mailbox.delivered_at) < total or mailbox.idle_since is None:
+			return False
+		if any(uid not in mailbox.touched_at for uid in mailbox.delivered_at):
+			return False
+
+	if options.outbox and Outbox(CONFIG_NAME).has_pending():
+		return False
+
+	## Erst fertig, wenn der Empfänger nach der letzten Änderung wieder im IDLE wartet
+	return mailbox.idle_since > max(mailbox.touched_at.values())
+
+def report(options, mailbox, lexoffice, started, rss):
+	## Vorab eingelieferte Mails zählen erst ab dem Start des Empfängers
+	latencies = [mailbox.touched_at[uid] - max(delivered, started) for uid, delivered in mailbox.delivered_at.items() if uid in mailbox.touched_at]
+	duration = max(mailbox.touched_at.values()) - started if mailbox.touched_at else float("nan")
+	remaining = len(mailbox.inbox)
+	unseen = len([m for m in mailbox.inbox if SEEN not in m.flags])
+
+	lines = [
+		("Mails", "{0}".format(options.messages)),
+		("Dauer", "{0:.2f} s".format(duration)),
+		("Durchsatz", "{0:.1f} Mails/s".format(options.messages / duration if duration else float("nan"))),
+		("Latenz p50", "{0:.3f} s".format(percentile(latencies, 50))),
+		("Latenz p99", "{0:.3f} s".format(percentile(latencies, 99))),
+		("Latenz max", "{0:.3f} s".format(max(latencies) if latencies else float("nan"))),
+		("Verschoben", "{0}".format(len([uid for uid in mailbox.moved if uid not in [m.uid for m in mailbox.inbox]]))),
+		("In INBOX", "{0} (davon ungelesen {1})".format(remaining, unseen)),
+		("Uploads", "{0} ({1:.1f} MiB)".format(lexoffice.counters.get("uploads", 0), lexoffice.counters.get("upload_bytes", 0) / 1048576.0)),
+		("Logins", "{0} (401-Antworten {1})".format(lexoffice.counters.get("logins", 0), lexoffice.counters.get("unauthorized", 0))),
+		("Fehler (injiziert)", "{0}".format(lexoffice.counters.get("errors", 0))),
+		("Anfragen/s (Spitze)", "{0}".format(max(lexoffice.per_second.values()) if lexoffice.per_second else 0)),
+		("Peak RSS Empfänger", "{0:.1f} MiB".format(rss / 1024.0)),
+	]
+
+	width = max(len(name) for name, value in lines)
+	for name, value in lines:
+		print("{0:<{1}}  {2}".format(name, width, value))
+
+def main():
+	parser = argparse.ArgumentParser(description="Lasttest für ImapReceiver mit lokalem IMAP-Server und nachgebautem LexOffice")
+	parser.add_argument('-n', '--messages', type=int, default=200, help="Anzahl synthetischer Mails")
+	parser.add_argument('--attachment-size', type=int, default=256, help="Mittlere Anhangsgröße in KiB")
+	parser.add_argument('--rate', type=float, default=0, help="Einlieferungsrate in Mails/s, 0 = alle vor dem Start einliefern")
+	parser.add_argument('--latency', type=float, default=0.05, help="Mittlere Antwortzeit des LexOffice-Dienstes in Sekunden")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="Anteil der LexOffice-Anfragen, die mit 503 beantwortet werden")
+	parser.add_argument('--rate-limit', type=float, default=None, help="lexoffice.rate_limit in Anfragen/s")
+	parser.add_argument('--retries', type=int, default=3, help="lexoffice.retries")
+	parser.add_argument('--session-lifetime', type=float, default=0, help="Nach so vielen Sekunden antwortet der LexOffice-Dienst mit 401, 0 = unbegrenzt")
+	parser.add_argument('--receiver', choices=["process", "async"], default="process", help="ImapReceiver.run oder AsyncReceiverPool")
+	parser.add_argument('--workers', type=int, default=8, help="Worker-Threads für --receiver async")
+	parser.add_argument('--partial-fetch', action='store_true', help="imap.partial_fetch")
+	parser.add_argument('--upload-workers', type=int, default=0, help="imap.upload_workers")
+	parser.add_argument('--queue-size', type=int, default=16, help="imap.queue_size")
+	parser.add_argument('--fetch-chunk-size', type=int, default=None, help="imap.fetch_chunk_size")
+	parser.add_argument('--disposition-batch-size', type=int, default=50, help="imap.disposition_batch_size")
+	parser.add_argument('--no-dedup', action='store_true', help="imap.dedup ausschalten")
+	parser.add_argument('--incremental', action='store_true', help="imap.incremental")
+	parser.add_argument('--outbox', action='store_true', help="imap.outbox")
+	parser.add_argument('--timeout', type=float, default=600, help="Abbruch nach so vielen Sekunden")
+	parser.add_argument('--seed', type=int, default=1, help="Startwert für die Mail-Erzeugung")
+	parser.add_argument('-v', '--verbose', action='store_true', help="Log-Ausgaben des Empfängers anzeigen")
+
+	options = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+	logging.getLogger("requests.packages.urllib3").setLevel(logging.DEBUG if options.verbose else logging.WARNING)
+
+	## Zustand (Ledger, Checkpoints, Outbox) landet im Arbeitsverzeichnis, also frisch anfangen
+	workdir = tempfile.mkdtemp(prefix="lexofficetools-loadtest-")
+	os.chdir(workdir)
+
+	mailbox = ImapMailbox()
+	imap_server = ImapServer(("127.0.0.1", 0), mailbox)
+	lexoffice = LexofficeServer(("127.0.0.1", 0), latency=options.latency, error_rate=options.error_rate,
+		session_lifetime=options.session_lifetime)
+
+	for server in (imap_server, lexoffice):
+		thread = threading.Thread(target=server.serve_forever, name=server.__class__.__name__)
+		thread.daemon = True
+		thread.start()
+
+	mails = generate_mails(options)
+	if not options.rate:
+		for data in mails:
+			mailbox.deliver(data)
+
+	config = receiver_configuration(options, imap_server.server_address[1], lexoffice.server_address[1])
+	process = multiprocessing.Process(target=run_receiver, args=(options, config), name="Receiver")
+
+	started = time.time()
+	process.start()
+
+	if options.rate:
+		for i, data in enumerate(mails):
+			delay = started + i / options.rate - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			mailbox.deliver(data)
+
+	try:
+		while not is_finished(mailbox, options, options.messages):
+			if not process.is_alive():
+				print("Empfänger unerwartet beendet (Exit-Code {0})".format(process.exitcode), file=sys.stderr)
+				return 1
+			if time.time() - started > options.timeout:
+				print("Zeitüberschreitung nach {0} s".format(options.timeout), file=sys.stderr)
+				break
+			time.sleep(0.1)
+	finally:
+		process.terminate()
+		process.join()
+
+	rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	print("Arbeitsverzeichnis: {0}".format(workdir))
+	report(options, mailbox, lexoffice, started, rss)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
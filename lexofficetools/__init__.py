@@ -3,12 +3,19 @@ import logging
 import argparse
 import multiprocessing
 import pprint
+import os, os.path
+import shutil
+import datetime
+import collections
 
 from .config import ConfigurationManager
 from .mail import ImapReceiver
+from .aiomail import AsyncReceiverPool
 from .atos_cc import CreditScraperManager
-from .cc_sync import FinancialAccountManager
+from .cc_sync import FinancialAccountManager, sync_credit_accounts, wait_for_all_imports, SYNC_WORKERS
 from .lexoffice import RestClient
+from .metrics import REGISTRY, MetricsExporter
+from .utils import STATE_DIRECTORY, METRICS_DIRECTORY
 
 
 logging.basicConfig()
@@ -18,9 +25,19 @@ requests_log.setLevel(logging.DEBUG)
 requests_log.propagate = True
 logging.getLogger("chardet.charsetprober").setLevel(logging.WARNING)
 
+def parse_date(value):
+	return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-m', '--mode', choices=["daemon", "fetch_credit", "fetch_transactions", "sync_credit", "debug_config"], default="daemon", help="Execution mode")
+	parser.add_argument('--receiver', choices=["process", "async"], default="process", help="Daemon mode: one process per configuration, or all configurations in one event loop")
+	parser.add_argument('--workers', type=int, default=8, help="Number of worker threads for --receiver async")
+	parser.add_argument('--sync-workers', type=int, default=SYNC_WORKERS, help="sync_credit: number of accounts synchronized in parallel")
+	parser.add_argument('--metrics-port', type=int, default=None, help="Serve metrics in Prometheus format on this local port")
+	parser.add_argument('--metrics-textfile', default=None, help="Write metrics in Prometheus format to this file (textfile collector)")
+	parser.add_argument('--since', type=parse_date, default=None, help="fetch_transactions: only transactions on or after this date (YYYY-MM-DD)")
+	parser.add_argument('--until', type=parse_date, default=None, help="fetch_transactions: only transactions on or before this date (YYYY-MM-DD)")
 	parser.add_argument('config_yaml', nargs='+', type=argparse.FileType('r'), help="Configuration file(s) in YAML format")
 
 	args = parser.parse_args()
@@ -29,7 +46,34 @@ def main():
 	for fp in args.config_yaml:
 		c.load(fp)
 
-	if args.mode == "daemon":
+	exporter = None
+	metrics_directory = None
+	if args.metrics_port is not None or args.metrics_textfile is not None:
+		## Eigenes Verzeichnis je Aufruf, damit sich z.B. Daemon und sync_credit nicht gegenseitig stören
+		metrics_directory = os.path.join(STATE_DIRECTORY, METRICS_DIRECTORY, str(os.getpid()))
+		shutil.rmtree(metrics_directory, ignore_errors=True)
+		REGISTRY.enable(metrics_directory)
+
+		exporter = MetricsExporter()
+		if args.metrics_port is not None:
+			exporter.start_http_server(args.metrics_port)
+		if args.metrics_textfile is not None:
+			exporter.start_textfile_writer(args.metrics_textfile)
+
+	try:
+		run_mode(args, c)
+	finally:
+		if exporter is not None and args.metrics_textfile is not None:
+			exporter.write_textfile(args.metrics_textfile)
+		if metrics_directory is not None:
+			REGISTRY.disable()
+			shutil.rmtree(metrics_directory, ignore_errors=True)
+
+def run_mode(args, c):
+	if args.mode == "daemon" and args.receiver == "async":
+		AsyncReceiverPool(c.configurations(), max_workers=args.workers).run()
+
+	elif args.mode == "daemon":
 		subprocesses = []
 		for configuration in c.configurations():
 			i = ImapReceiver(configuration)
@@ -57,12 +101,17 @@ def main():
 			for account in m.all_accounts():
 				print(account)
 				if account.financial_account_id:
-					pprint.pprint(m.c.get_financial_transactions(financial_account_id=account.financial_account_id))
+					for transaction in m.c.iter_financial_transactions(financial_account_id=account.financial_account_id, since=args.since, until=args.until):
+						pprint.pprint(transaction)
 
 	elif args.mode == "sync_credit":
+		## Importe aller Konten erst parallel anstoßen, dann gemeinsam abwarten
+		managers = []
+		tasks = []
 		for configuration in c.configurations():
 			if 'cc' in configuration:
 				f = FinancialAccountManager(configuration)
+				managers.append(f)
 				f.fetch_accounts()
 
 				m = CreditScraperManager(configuration)
@@ -78,7 +127,36 @@ def main():
 
 				for account in f.all_accounts():
 					if account.type_ == 'creditcard' and account.card_no is not None:
-						f.sync_credit_transactions(account, m.get_transactions(account.card_no))
+						tasks.append( (f, account, m.get_transactions(account.card_no)) )
+
+		results = sync_credit_accounts(tasks, args.sync_workers)
+
+		statuses = wait_for_all_imports(managers)
+		results = [result.with_import_statuses(statuses) for result in results]
+
+		for result in results:
+			if result.error is not None:
+				summary = "Fehler: {0}".format(result.error)
+			elif result.skipped:
+				summary = "übersprungen, ein früherer Import läuft noch"
+			elif not result.imports:
+				summary = "nichts zu importieren"
+			else:
+				## PENDING ist kein Fehler, der nächste Lauf verfolgt diese Importe weiter
+				parts = ["{0} {1}".format(count, status) for (status, count) in sorted(collections.Counter(result.imports.values()).items()) if status != "PENDING"]
+				if result.carried_over:
+					parts.append("{0} offen, wird beim nächsten Lauf weiter verfolgt".format(result.carried_over))
+				summary = "{0} Import(e): {1}".format(len(result.imports), ", ".join(parts))
+			print("{0}: {1} ({2:.1f} s)".format(result.account, summary, result.seconds))
+
+		## Importe früherer Läufe, die keinem Konto dieses Laufs zugeordnet sind
+		own_imports = set(import_id for result in results for import_id in result.imports or {})
+		failed_imports = [import_id for import_id, status in statuses.items() if import_id not in own_imports and status not in ("DONE", "PENDING")]
+
+		failed = [result for result in results if result.failed]
+		if failed or failed_imports:
+			raise SystemExit("Abgleich bei {0} von {1} Konten fehlgeschlagen, {2} frühere(r) Import(e) fehlgeschlagen".format(
+				len(failed), len(results), len(failed_imports)))
 
 	else:
 		pprint.pprint(c.configs)
@@ -0,0 +1,342 @@
+import asyncio
+import os.path
+import random
+import logging
+import http.cookies
+
+try:
+	import aiohttp
+	from yarl import URL
+except ImportError:
+	aiohttp = None
+
+from .lexoffice import URLS, USER_AGENT, TRANSPORT_DEFAULTS, TRANSACTION_PAGE_SIZE, IDEMPOTENT_METHODS, IDEMPOTENT_ENDPOINTS, \
+	RETRY_ALWAYS, RETRY_IDEMPOTENT, MultipartStream, account_key, transaction_date, retry_after
+from .metrics import LEXOFFICE_SECONDS, LEXOFFICE_LOGINS, LEXOFFICE_RETRIES, LEXOFFICE_THROTTLE_SECONDS
+from .state import SessionCache, RateLimiter
+
+def is_connect_error(exc):
+	"""Ob die Verbindung gar nicht erst zustande kam, die Anfrage also sicher nicht angekommen ist."""
+	return isinstance(exc, (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', ())))
+
+def export_cookies(jar):
+	## Gleiches Format wie lexoffice.export_cookies, damit sich beide Clients den SessionCache teilen
+	return [
+		{"name": morsel.key, "value": morsel.value, "domain": morsel["domain"], "path": morsel["path"] or "/",
+			"secure": bool(morsel["secure"]), "expires": None}
+		for morsel in jar
+	]
+
+class AsyncRestClient(object):
+	"""asyncio-Gegenstück zu RestClient mit denselben Methoden als Koroutinen, auf aiohttp
+	(pip install lexofficetools[async]).
+
+	Anmeldung, Erneuerung der Sitzung bei 401/403, Wiederholungen und das prozessübergreifende
+	Rate-Limit verhalten sich wie im synchronen Client. Alle Aufrufe teilen sich einen
+	Verbindungs-Pool mit transport pool_size Verbindungen. Das Objekt gehört zu der
+	Event-Loop, in der es zuerst benutzt wird."""
+
+	def __init__(self, configuration):
+		if aiohttp is None:
+			raise ImportError("Für AsyncRestClient wird aiohttp benötigt (pip install lexofficetools[async])")
+
+		self.config = configuration
+		self.logger = logging.getLogger('lexofficetools.aiolexoffice[{0}]'.format(configuration.name))
+		self.session = None
+		self.cookies = None
+		## Die Cookies liegen im Klartext in der Zustandsdatenbank, deshalb nur auf Wunsch
+		self.sessions = None
+		if configuration['lexoffice'].get('session_cache', False):
+			self.sessions = SessionCache()
+		self._login_lock = None
+		self._login = None
+		self._generation = 0
+
+		self.transport = dict(TRANSPORT_DEFAULTS)
+		self.transport.update( (k, v) for (k, v) in configuration['lexoffice'].items() if k in TRANSPORT_DEFAULTS )
+
+		self.limiter = None
+		if self.transport["rate_limit"]:
+			self.limiter = RateLimiter(configuration['lexofficeInstance'], self.transport["rate_limit"], self.transport["rate_burst"])
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await self.close()
+
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	def ensure_session(self):
+		if not self.session:
+			connect, read = self.transport["timeout"]
+			## Cookies verwaltet der Client selbst (self.cookies), damit login() sie auf einmal austauschen kann
+			self.session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.transport["pool_size"]),
+				cookie_jar=aiohttp.DummyCookieJar(),
+				headers={'User-Agent': USER_AGENT},
+				timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+			)
+			self.cookies = aiohttp.CookieJar(unsafe=True)
+			self._login_lock = asyncio.Lock()
+
+	def get_url(self, endpoint, **kwargs):
+		values = dict(**self.config)
+		values.update(kwargs)
+		return URLS[endpoint].format(**values)
+
+	async def _state(self, function, *args):
+		## Die Zustandsdatenbank kann bei Sperren warten, das soll die Event-Loop nicht aufhalten
+		return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+	async def request(self, method, endpoint, url_params={}, **kwargs):
+		"""Wie RestClient.request, der Body der Antwort ist bei der Rückgabe schon gelesen."""
+		self.ensure_session()
+		generation = self._generation
+		r = await self._send_retrying(method, endpoint, url_params, **kwargs)
+
+		if r.status in (401, 403) and endpoint != 'login':
+			## Sitzung abgelaufen (oder aus dem Cache veraltet): neu anmelden und einmal wiederholen
+			await self.refresh_login(generation)
+			r = await self._send_retrying(method, endpoint, url_params, **kwargs)
+
+		r.raise_for_status()
+		return r
+
+	async def _send_retrying(self, method, endpoint, url_params, cookies=None, **kwargs):
+		idempotent = method in IDEMPOTENT_METHODS or endpoint in IDEMPOTENT_ENDPOINTS
+		attempt = 0
+
+		while True:
+			try:
+				r = await self._send(method, endpoint, url_params, self.cookies if cookies is None else cookies, **kwargs)
+
+			except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+				## Kam keine Verbindung zustande, ist sicher nichts angekommen, sonst nur idempotent wiederholen
+				if attempt >= self.transport["retries"] or not (idempotent or is_connect_error(e)):
+					raise
+				reason, delay = e.__class__.__name__, self.backoff(attempt)
+
+			else:
+				if attempt >= self.transport["retries"]:
+					return r
+				if not (r.status in RETRY_ALWAYS or (idempotent and r.status in RETRY_IDEMPOTENT)):
+					return r
+				reason, delay = str(r.status), retry_after(r)
+				if delay is None:
+					delay = self.backoff(attempt)
+				delay = min(self.transport["max_backoff"], delay)
+
+			LEXOFFICE_RETRIES.inc(endpoint=endpoint, reason=reason)
+			self.logger.warning("lexoffice-Aufruf %s fehlgeschlagen (%s), neuer Versuch in %.1f Sekunden", endpoint, reason, delay)
+			await asyncio.sleep(delay)
+			attempt = attempt + 1
+
+	def backoff(self, attempt):
+		return min(self.transport["max_backoff"], self.transport["backoff"] * 2**attempt) * random.uniform(0.5, 1.0)
+
+	async def _send(self, method, endpoint, url_params, cookies, body=None, **kwargs):
+		if self.limiter is not None:
+			delay = await self._state(self.limiter.reserve)
+			if delay:
+				LEXOFFICE_THROTTLE_SECONDS.inc(delay, instance=self.config['lexofficeInstance'])
+				await asyncio.sleep(delay)
+
+		url = URL(self.get_url(endpoint, **url_params), encoded=False)
+		if body is not None:
+			body.rewind()
+			kwargs['data'] = read_stream(body)
+			kwargs['headers'] = {'Content-Type': body.content_type, 'Content-Length': str(len(body))}
+
+		with LEXOFFICE_SECONDS.time(endpoint=endpoint, status="error") as labels:
+			async with self.session.request(method, url, cookies=cookies.filter_cookies(url), **kwargs) as r:
+				await r.read()
+				cookies.update_cookies(r.cookies, r.url)
+			labels["status"] = r.status
+		return r
+
+	async def refresh_login(self, generation):
+		"""Meldet neu an, außer ein anderer Aufruf hat das seit generation schon getan."""
+		async with self._login_lock:
+			if generation == self._generation:
+				await self._do_login()
+
+	async def json_api_post(self, endpoint, params):
+		return await (await self.request('POST', endpoint, json=params)).json()
+
+	async def json_api_get(self, endpoint, params=None, url_params={}):
+		return await (await self.request('GET', endpoint, url_params, params=params)).json()
+
+	async def json_api_put(self, endpoint, params, url_params={}):
+		return await (await self.request('PUT', endpoint, url_params, json=params)).json()
+
+	async def json_api_multipart(self, endpoint, params):
+		return await (await self.request('POST', endpoint, body=MultipartStream(params))).json()
+
+	async def ensure_login(self):
+		"""Wie RestClientUser.ensure_login: gespeicherte Sitzung übernehmen, sonst anmelden.
+		Gleichzeitige Aufrufe warten auf dieselbe Anmeldung."""
+		if self._login is None:
+			self._login = asyncio.ensure_future(self._ensure_login())
+		try:
+			await asyncio.shield(self._login)
+		except:
+			self._login = None
+			raise
+
+	async def _ensure_login(self):
+		if not await self.restore_session():
+			await self.login()
+
+	async def login(self):
+		self.ensure_session()
+		async with self._login_lock:
+			return await self._do_login()
+
+	async def _do_login(self):
+		"""Meldet mit einem leeren Cookie-Speicher an und übernimmt ihn erst danach.
+		Andere Aufrufe laufen bis dahin mit der alten Sitzung weiter."""
+		cookies = aiohttp.CookieJar(unsafe=True)
+		r = await self._send_retrying('POST', 'login', {}, cookies=cookies, json=self.config['lexoffice']['auth'])
+		r.raise_for_status()
+		result = await r.json()
+
+		self.cookies = cookies
+		self._generation = self._generation + 1
+		LEXOFFICE_LOGINS.inc(configuration=self.config.name)
+
+		if self.sessions is not None:
+			await self._state(self.sessions.save, self.config.name, account_key(self.config), export_cookies(cookies))
+		return result
+
+	async def restore_session(self):
+		"""Übernimmt die Cookies einer früheren Sitzung, True wenn es welche gab."""
+		if self.sessions is None:
+			return False
+
+		cookies = await self._state(self.sessions.load, self.config.name, account_key(self.config))
+		if not cookies:
+			return False
+
+		self.ensure_session()
+		for cookie in cookies:
+			morsel = http.cookies.Morsel()
+			morsel.set(cookie["name"], cookie["value"], cookie["value"])
+			morsel["path"] = cookie.get("path") or "/"
+			if cookie.get("secure"):
+				morsel["secure"] = True
+			domain = cookie.get("domain") or self.config['lexofficeInstance']
+			if domain.startswith("."):
+				morsel["domain"] = domain
+			self.cookies.update_cookies({cookie["name"]: morsel}, URL("{0}://{1}/".format(self.config['lexofficeScheme'], domain.lstrip("."))))
+		return True
+
+	async def logout(self):
+		result = await self.json_api_get('logout')
+		if self.sessions is not None:
+			await self._state(self.sessions.clear, self.config.name)
+		return result
+
+	async def privilege(self):
+		return await self.json_api_get('privilege')
+
+	async def upload_image(self, filename, data = None, content_type='application/octet-stream'):
+		"""data kann bytes oder ein Dateiobjekt sein, ohne data wird die Datei filename hochgeladen."""
+		if not data:
+			with open(filename, "rb") as fp:
+				return await self.upload_image(filename, fp, content_type)
+
+		params = {
+			"file": (os.path.basename(filename), data, content_type),
+			"uploadType": (None, 'voucher', 'text/plain;charset=ISO-8859-1'),
+		}
+		return await self.json_api_multipart('uploadBookkeepingVoucherImage', params)
+
+	async def upload_csv_data(self, filename, data, content_type='application/vnd.ms-excel'):
+		params = {
+			"file": (os.path.basename(filename), data, content_type),
+			"uploadType": (None, 'csv', None),
+		}
+		return await self.json_api_multipart('uploadCsvFile', params)
+
+	async def put_importprofile(self, account, settings):
+		return await self.json_api_put('put_importprofile', settings, {'financial_account_id': account.financial_account_id})
+
+	async def get_importstate(self, financial_transaction_import_id):
+		return await self.json_api_get('get_importstate', url_params={'financial_transaction_import_id': financial_transaction_import_id})
+
+	async def csv_preview(self, file_id):
+		params = {
+			"fileId": file_id,
+			"delimiter": "Semicolon",
+			"quoteCharacter": "DoubleQuote",
+			"characterSet": "UTF-8",
+			"negateAmount": False,
+		}
+		return await self.json_api_post('csvPreview', params)
+
+	async def do_import(self, account, file_id, description):
+		params = {
+			"fileId": file_id,
+			"financialAccount": {
+				"financialAccountId": account.financial_account_id,
+				"name": account.name,
+			},
+			"description": description,
+		}
+		return await self.json_api_post('import', params)
+
+	async def list_financial_accounts(self):
+		return await self.json_api_get('financialAccounts')
+
+	async def get_financial_transactions(self, first_row=0, num_rows=60, search_state=None, financial_account_id=None):
+		params = {
+			"firstRow": first_row,
+			"numRows": num_rows,
+		}
+		if search_state is not None:
+			params['searchState'] = search_state
+		if financial_account_id is not None:
+			params['financialAccountId'] = financial_account_id
+		return await self.json_api_get('financialTransactions', params)
+
+	async def iter_financial_transactions(self, financial_account_id=None, search_state=None, since=None, until=None, page_size=None):
+		"""Wie RestClient.iter_financial_transactions als asynchroner Iterator (async for),
+		die nächste Seite wird schon geholt, während der Aufrufer die aktuelle bearbeitet."""
+		page_size = page_size or self.config['lexoffice'].get('transaction_page_size', TRANSACTION_PAGE_SIZE)
+
+		def fetch(first_row):
+			return asyncio.ensure_future(self.get_financial_transactions(first_row, page_size, search_state, financial_account_id))
+
+		first_row = 0
+		future = fetch(first_row)
+		try:
+			while future is not None:
+				page = await future
+				first_row = first_row + len(page)
+				dates = [transaction_date(item) for item in page]
+
+				future = None
+				exhausted = since is not None and dates and all(date is not None and date < since for date in dates)
+				if len(page) >= page_size and not exhausted:
+					future = fetch(first_row)
+
+				for item, date in zip(page, dates):
+					if date is not None and ((since is not None and date < since) or (until is not None and date > until)):
+						continue
+					yield item
+		finally:
+			if future is not None:
+				future.cancel()
+
+async def read_stream(body, chunk_size=64*1024):
+	"""Liest einen MultipartStream stückweise, Dateien im Thread-Pool statt in der Event-Loop."""
+	loop = asyncio.get_event_loop()
+	while True:
+		chunk = await loop.run_in_executor(None, body.read, chunk_size)
+		if not chunk:
+			break
+		yield chunk
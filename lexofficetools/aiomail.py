@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import concurrent.futures
+from signal import SIGINT, SIGTERM
+
+from .mail import ImapReceiver
+
+RECONNECT_DELAY = 60
+
+class AsyncReceiverPool(object):
+	"""Betreibt die ImapReceiver vieler Konfigurationen in einem Prozess.
+
+	Das Warten im IMAP IDLE läuft über die Event-Loop (add_reader auf dem Socket),
+	nur die eigentliche Bearbeitung eines Postfachs läuft mit der unveränderten
+	Logik aus ImapReceiver in einem gemeinsamen Thread-Pool.
+
+	SIGINT/SIGTERM nimmt die Event-Loop entgegen: laufende Durchläufe werden noch
+	beendet, danach melden sich alle Empfänger ab."""
+
+	def __init__(self, configurations, max_workers=8):
+		self.receivers = [ImapReceiver(configuration) for configuration in configurations]
+		for receiver in self.receivers:
+			receiver.protect_signals = False
+		self.max_workers = max_workers
+		self.executor = None
+		self._stop = None
+		self.logger = logging.getLogger('lexofficetools.aiomail')
+
+	def run(self):
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+		loop = asyncio.new_event_loop()
+		try:
+			asyncio.set_event_loop(loop)
+			self._stop = asyncio.Event()
+			for signum in (SIGINT, SIGTERM):
+				loop.add_signal_handler(signum, self.stop)
+			loop.run_until_complete( asyncio.gather(*[self.run_receiver(receiver) for receiver in self.receivers]) )
+		finally:
+			for signum in (SIGINT, SIGTERM):
+				loop.remove_signal_handler(signum)
+			loop.close()
+			self.executor.shutdown()
+
+	def stop(self):
+		self.logger.info("Beenden angefordert, laufende Durchläufe werden noch abgeschlossen")
+		self._stop.set()
+
+	async def run_receiver(self, receiver):
+		loop = asyncio.get_event_loop()
+
+		while not self._stop.is_set():
+			server = None
+			try:
+				server = await loop.run_in_executor(self.executor, receiver.connect)
+
+				while not self._stop.is_set():
+					await loop.run_in_executor(self.executor, receiver.process_mailbox, server)
+					if not self._stop.is_set():
+						await self.idle_wait(server, receiver.idle_timeout())
+
+			except asyncio.CancelledError:
+				raise
+
+			except:
+				receiver.logger.exception("Fehler im Empfang, neuer Versuch in {0} Sekunden".format(RECONNECT_DELAY))
+				await self.logout(server)
+				await self.wait_stop(RECONNECT_DELAY)
+
+			else:
+				await self.logout(server)
+
+	async def logout(self, server):
+		if server is not None:
+			try:
+				await asyncio.get_event_loop().run_in_executor(self.executor, server.logout)
+			except:
+				pass
+
+	async def wait_stop(self, timeout):
+		try:
+			await asyncio.wait_for(self._stop.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+	@staticmethod
+	def has_buffered(server):
+		## Was die SSL-Schicht schon entschlüsselt hat, meldet der Socket nicht mehr als lesbar
+		pending = getattr(server.socket(), 'pending', None)
+		return pending is not None and pending() > 0
+
+	async def idle_wait(self, server, timeout):
+		loop = asyncio.get_event_loop()
+
+		await loop.run_in_executor(self.executor, server.idle)
+		try:
+			if not self.has_buffered(server):
+				readable = asyncio.Event()
+				sock = server.socket()
+				loop.add_reader(sock, readable.set)
+				waiters = [asyncio.ensure_future(readable.wait()), asyncio.ensure_future(self._stop.wait())]
+				try:
+					await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+				finally:
+					loop.remove_reader(sock)
+					for waiter in waiters:
+						waiter.cancel()
+		finally:
+			## idle_done liest die Antworten selbst, im Thread-Pool statt in der Event-Loop
+			text, responses = await loop.run_in_executor(self.executor, server.idle_done)
+		return responses
@@ -12,7 +12,8 @@ import os, os.path
 
 from bs4 import BeautifulSoup, NavigableString, Comment, Tag
 
-from .utils import CardNumber, LoginError, normalize_date_TTMMJJJJ, symmetric_difference
+from .utils import CardNumber, LoginError, normalize_date_TTMMJJJJ, MultisetIndex
+from .metrics import SCRAPER_SECONDS
 from .utils import DOCUMENT_DIRECTORY, CARD_DIRECTORY, CARD_CSV, CARD_STATEMENT_CSV, CARD_STATEMENT_PDF
 
 DBG_counter = None
@@ -155,7 +156,9 @@ class ScraperBase(object):
 		return BeautifulSoup(self.current_page.content, 'lxml')
 
 	def navigate(self, url):
-		self.current_page = self.session.get( self.resolve_url(url) )
+		with SCRAPER_SECONDS.time(method="GET", status="error") as labels:
+			self.current_page = self.session.get( self.resolve_url(url) )
+			labels["status"] = self.current_page.status_code
 		
 		_DBG_out(self.soup.prettify())
 
@@ -227,7 +230,9 @@ class ScraperBase(object):
 
 		_DBG_out(pprint.pformat(request_data))
 
-		self.current_page = self.session.post(action, data=request_data)
+		with SCRAPER_SECONDS.time(method="POST", status="error") as labels:
+			self.current_page = self.session.post(action, data=request_data)
+			labels["status"] = self.current_page.status_code
 
 		_DBG_out(self.soup.prettify())
 
@@ -303,7 +308,8 @@ class CardDataScraper(ScraperBase):
 		os.makedirs(os.path.dirname(csv_name), exist_ok=True)
 
 		have_header = False
-		old_entries = []
+		## Bekannte Umsätze nur einmal einlesen, jede Seite wird dann nur gegen den Index geprüft
+		old_entries = MultisetIndex(key=map_transaction_equiv)
 		changed = False
 
 		with open(csv_name, 'a+', newline='') as fp:
@@ -315,7 +321,7 @@ class CardDataScraper(ScraperBase):
 					continue
 
 				data = Transaction._make(row)
-				old_entries.append(data)
+				old_entries.add(data)
 
 			writer = csv.writer(fp)
 			if not have_header and len(old_entries) == 0:
@@ -324,18 +330,16 @@ class CardDataScraper(ScraperBase):
 			for statement in self.get_statement_links():
 				if not statement.have_csv:
 					new_entries = self.get_transactions(statement.form)
-					missing, expired = symmetric_difference(new_entries, old_entries, map_to_equiv=map_transaction_equiv, transform_b=Transaction._make )
-					for transaction in missing:
+					for transaction in list(old_entries.missing(new_entries)):
 						writer.writerow(transaction)
-						old_entries.append(transaction)
+						old_entries.add(transaction)
 						changed = True
 					self.download_statement_csv(statement)
 
 			new_entries = self.get_transactions()
-			missing, expired = symmetric_difference(new_entries, old_entries, map_to_equiv=map_transaction_equiv, transform_b=Transaction._make )
-			for transaction in missing:
+			for transaction in list(old_entries.missing(new_entries)):
 				writer.writerow(transaction)
-				old_entries.append(transaction)
+				old_entries.add(transaction)
 				changed = True
 
 		return changed
@@ -1,12 +1,100 @@
 
-from .lexoffice import RestClientUser
-from .utils import CardNumber, symmetric_difference
+from .lexoffice import RestClientUser, transaction_date, is_permanent_error, TRANSACTION_PAGE_SIZE
+from .utils import CardNumber, MultisetIndex
+from .state import TransactionMirror, ImportJournal, ImportProfiles
+from .spool import spooled_file
 import pprint
 import csv
 import io
 import datetime
 import time
 import html
+import collections
+import logging
+import random
+import concurrent.futures
+
+## Umsätze in lexoffice werden ab so vielen Tagen vor dem ältesten Kreditkartenumsatz verglichen
+SYNC_DATE_SLACK = 7
+
+## Die lokale Kopie der Umsätze wird nach so vielen Sekunden einmal komplett neu geladen,
+## dazwischen nur die neuesten Seiten und nach Importen deren Datumsbereich.
+## Überschreibbar mit lexoffice.mirror_full_refresh.
+MIRROR_FULL_REFRESH = 7*24*60*60
+
+## Warten auf Importe: Abfrageabstand wächst von IMPORT_POLL_MIN bis IMPORT_POLL_MAX Sekunden,
+## nach lexoffice.import_deadline Sekunden wird abgebrochen und beim nächsten Lauf weiter gewartet
+IMPORT_DEADLINE = 120
+IMPORT_POLL_MIN = 1
+IMPORT_POLL_MAX = 30
+IMPORT_POLL_FACTOR = 1.5
+
+## So viele Konten werden gleichzeitig abgeglichen, überschreibbar mit --sync-workers
+SYNC_WORKERS = 4
+
+## Ergebnis von sync_credit_transactions, wenn das Konto wegen eines laufenden Imports übersprungen wurde
+SKIPPED = "SKIPPED"
+
+## Höchstens so viele Umsätze je Import, überschreibbar mit lexoffice.import_chunk_size
+IMPORT_CHUNK_SIZE = 500
+
+## Fixe Import-Settings
+IMPORT_SETTINGS = {
+	"characterSet": "UTF-8",
+	"delimiter": "Semicolon",
+	"quoteCharacter": "DoubleQuote",
+	"negateAmount": False,
+	"fieldMappings": [
+		{"columnIndex": 2, "fieldName": "ValueDate"},
+		{"columnIndex": 3, "fieldName": "Purpose"},
+		{"columnIndex": 6, "fieldName": "Amount"},
+	]
+}
+
+## lexoffice hat den Import mit einer unerwarteten Antwort abgelehnt und nicht angestoßen
+class ImportRejected(IOError): pass
+
+def write_transactions_csv(account, transactions, fp):
+	"""Schreibt die Umsätze als CSV in UTF-8 zeilenweise in die Binärdatei fp."""
+	line = io.StringIO()
+	writer = csv.writer(line, delimiter=";")
+	for transaction in transactions:
+		purpose = transaction.mainDescription.strip()
+		if transaction.additionalDescription.strip():
+			purpose = "{0} / {1}".format(purpose, transaction.additionalDescription.strip())
+
+		writer.writerow( 
+			[account.card_no,
+				transaction.postingDate,
+				transaction.purchaseDate,
+				purpose,
+				"", "",   # Fremdwährung und Kurs
+				transaction.signed_amount.replace('+','')]
+		)
+
+		fp.write(line.getvalue().encode("UTF-8"))
+		line.seek(0)
+		line.truncate()
+
+	fp.seek(0)
+
+def card_transaction_key(item):
+	return (item.purchaseDate, item.signed_amount, item.mainDescription, item.additionalDescription)
+
+def lexoffice_transaction_key(item):
+	purpose = html.unescape(item['purpose'])
+	if ' / ' in purpose:
+		description_a = purpose.rsplit(' / ', 1)[0].strip()
+		description_b = purpose.rsplit(' / ', 1)[1].strip()
+	else:
+		description_a = purpose.strip()
+		description_b = ''
+
+	amount = "{0:+.2f}".format( item['amount'] ).replace('.', ',')
+
+	date = item['dateLocalized'] # FIXME
+
+	return (date, amount, description_a, description_b)
 
 def rename(d):
 	mapping={"type": "type_", "financialAccountId": "financial_account_id"}
@@ -16,9 +104,13 @@ def rename(d):
 	return d
 
 class Account(object):
+	_registry = None
+
 	def __init__(self, **kwargs):
 		kwargs = rename(kwargs)
 		self._card_no = None
+		self._financial_account_id = None
+		self._name = None
 
 		self.financial_account_id=kwargs.pop("financial_account_id", None)
 		self.card_no=kwargs.pop("card_no", None)
@@ -43,6 +135,28 @@ class Account(object):
 				setattr(self, i, kwargs.pop(i))
 		self.extra.update(kwargs)
 
+	def _reindex(self):
+		if self._registry is not None:
+			self._registry.reindex(self)
+
+	@property
+	def financial_account_id(self):
+		return self._financial_account_id
+
+	@financial_account_id.setter
+	def financial_account_id(self, value):
+		self._financial_account_id = value
+		self._reindex()
+
+	@property
+	def name(self):
+		return self._name
+
+	@name.setter
+	def name(self, value):
+		self._name = value
+		self._reindex()
+
 	@property
 	def card_no(self):
 		return self._card_no
@@ -56,12 +170,110 @@ class Account(object):
 				self._card_no = CardNumber.coerce(value)
 			else:
 				self._card_no.update(value)
+		self._reindex()
+
+
+## Kartennummern werden im Index nach den letzten Stellen einsortiert, die bei maskierten
+## Nummern praktisch immer bekannt sind. Nummern mit Platzhaltern dort landen in CARD_WILDCARD.
+CARD_INDEX_DIGITS = 4
+CARD_WILDCARD = "*"
+
+class AccountRegistry(object):
+	"""Konten in Reihenfolge des Hinzufügens, mit Indizes nach financial_account_id, Name
+	und Kartennummer. Ändert sich eines dieser Felder, sortiert das Konto sich selbst neu ein."""
+	def __init__(self):
+		self._accounts = []
+		self._keys = {}
+		self._by_id = collections.defaultdict(list)
+		self._by_name = collections.defaultdict(list)
+		self._by_card = collections.defaultdict(list)
+
+	def __iter__(self):
+		return iter(list(self._accounts))
+
+	def __len__(self):
+		return len(self._accounts)
+
+	@staticmethod
+	def card_bucket(card_no):
+		tail = str(card_no)[-CARD_INDEX_DIGITS:]
+		if 'x' in tail:
+			return CARD_WILDCARD
+		return tail
+
+	def add(self, account):
+		account._registry = self
+		self._accounts.append(account)
+		self._keys[account] = (len(self._accounts), None)
+		self.reindex(account)
+		return account
+
+	def _index_keys(self, account):
+		## ID und Name werden auch als None eingetragen, get(None) findet wie die lineare Suche
+		## Konten ohne ID oder Namen. Konten ohne Kartennummer fehlen nur im Kartenindex.
+		yield self._by_id, account.financial_account_id
+		yield self._by_name, account.name
+		if account.card_no is not None:
+			yield self._by_card, self.card_bucket(account.card_no)
+
+	def reindex(self, account):
+		position, keys = self._keys[account]
+		for index, key in keys or []:
+			index[key].remove(account)
+			if not index[key]:
+				del index[key]
+
+		keys = list(self._index_keys(account))
+		for index, key in keys:
+			index[key].append(account)
+
+		self._keys[account] = (position, keys)
+
+	def _card_matches(self, card_no):
+		bucket = self.card_bucket(card_no)
+		if bucket == CARD_WILDCARD:
+			candidates = [account for accounts in self._by_card.values() for account in accounts]
+		else:
+			candidates = self._by_card.get(bucket, []) + self._by_card.get(CARD_WILDCARD, [])
+		return [account for account in candidates if account.card_no == card_no]
+
+	def get(self, search):
+		"""Erstes passendes Konto in Reihenfolge des Hinzufügens, oder None. Eine CardNumber
+		wird nur mit Kartennummern verglichen, alles andere mit ID und Name und, wenn Ziffern
+		darin vorkommen, auch mit Kartennummern."""
+		if isinstance(search, CardNumber):
+			matches = self._card_matches(search)
+		else:
+			matches = []
+			try:
+				matches.extend(self._by_id.get(search, []))
+				matches.extend(self._by_name.get(search, []))
+			except TypeError:
+				pass
+
+			## Ohne Ziffern wäre das 'xxxxxxxxxxxxxxxx' und passte auf jede Karte
+			if isinstance(search, int) or (isinstance(search, str) and any(ch.isdigit() for ch in search)):
+				matches.extend(self._card_matches(CardNumber.coerce(search)))
+
+		if not matches:
+			return None
+		return min(matches, key=lambda account: self._keys[account][0])
 
 
 class FinancialAccountManager(RestClientUser):
 	def __init__(self, configuration):
 		super(FinancialAccountManager, self).__init__(configuration)
-		self._accounts = []
+		self.logger = logging.getLogger('lexofficetools.cc_sync[{0}]'.format(configuration.name))
+		self._accounts = AccountRegistry()
+		self.imports = ImportJournal(configuration.name)
+		## Weitere Teile eines aufgeteilten Imports: import_id -> (account, parts) bzw. erster Import der Kette
+		self._followups = {}
+		self._chain_roots = {}
+		self.profiles = ImportProfiles()
+
+		self.mirror = None
+		if configuration['lexoffice'].get('transaction_mirror', True):
+			self.mirror = TransactionMirror()
 
 	def fetch_accounts(self):
 		if 'cc' in self.config:
@@ -69,11 +281,11 @@ class FinancialAccountManager(RestClientUser):
 				if 'cards' in credit_config:
 					if isinstance(credit_config['cards'], dict):
 						for card, name in credit_config['cards'].items():
-							self._accounts.append(Account(name=name, card_no=card))
+							self._accounts.add(Account(name=name, card_no=card))
 
 					else:
 						for card in credit_config['cards']:
-							self._accounts.append(Account(card_no=card))
+							self._accounts.add(Account(card_no=card))
 
 
 		self.ensure_login()
@@ -86,8 +298,7 @@ class FinancialAccountManager(RestClientUser):
 				a = self.get(account['name'], None)
 
 			if a is None:
-				a = Account(**account)
-				self._accounts.append(a)
+				self._accounts.add(Account(**account))
 			else:
 				a.update(**account)
 
@@ -96,114 +307,317 @@ class FinancialAccountManager(RestClientUser):
 			yield account
 
 	def get(self, search, default=Ellipsis):
-		for account in self._accounts:
-
-			if isinstance(search, CardNumber):
-				if account.card_no == search:
-					return account
-			else:
-				if account.financial_account_id==search:
-					return account
-				elif account.name==search:
-					return account
-				elif account.card_no==search:
-					return account
+		account = self._accounts.get(search)
+		if account is not None:
+			return account
 
 		if default is Ellipsis:
 			raise KeyError
 		else:
 			return default
 
-	def sync_credit_transactions(self, account, transactions):
-		old_transactions = self.c.get_financial_transactions(financial_account_id=account.financial_account_id)
-
-		def transform_a(item):
-			return  (item.purchaseDate, item.signed_amount, item.mainDescription, item.additionalDescription)
-
-		def transform_b(item):
-			item['purpose'] = html.unescape(item['purpose'])
-			if ' / ' in item['purpose']:
-				description_a = item['purpose'].rsplit(' / ', 1)[0].strip()
-				description_b = item['purpose'].rsplit(' / ', 1)[1].strip()
-			else:
-				description_a = item['purpose'].strip()
-				description_b = ''
-
-			amount = "{0:+.2f}".format( item['amount'] ).replace('.', ',')
-
-			date = item['dateLocalized'] # FIXME
-
-			return (date, amount, description_a, description_b)
+	def sync_credit_transactions(self, account, transactions, wait=True):
+		"""Importiert fehlende Kreditkartenumsätze. Mit wait=False wird nur der Import
+		angestoßen und die ImportJobs geliefert, verfolgt werden sie mit wait_for_imports().
+		None, wenn nichts fehlt, SKIPPED, solange ein früherer Import des Kontos läuft."""
+		## Solange ein früherer Import läuft, fehlen dessen Umsätze noch in lexoffice
+		earlier = self.imports.pending(account.financial_account_id)
+		if earlier and 'PENDING' in self.wait_for_imports(earlier, deadline=0).values():
+			self.logger.warning("Für Konto %s läuft noch ein Import, Abgleich wird übersprungen", account)
+			return SKIPPED
 
-		missing, old = symmetric_difference(transactions, old_transactions, transform_a=transform_a, transform_b=transform_b)
+		transactions = list(transactions)
 
-		if len(missing):
-			self.upload_credit_transactions(account, missing)
+		if self.mirror is not None:
+			missing = self.missing_transactions(account, transactions)
+		else:
+			since = None
+			dates = [transaction_date({'dateLocalized': transaction.purchaseDate}) for transaction in transactions]
+			if dates and None not in dates:
+				since = min(dates) - datetime.timedelta(days=SYNC_DATE_SLACK)
+
+			index = MultisetIndex(transactions, key=card_transaction_key, date=lambda transaction: transaction_date({'dateLocalized': transaction.purchaseDate}))
+			old_transactions = self.c.iter_financial_transactions(financial_account_id=account.financial_account_id, since=since)
+			old, missing = index.diff(old_transactions, key=lexoffice_transaction_key, since=since)
+
+		if not len(missing):
+			return None
+
+		if wait:
+			return self.upload_credit_transactions(account, missing)
+		return self.submit_imports(account, missing)
+
+	def refresh_mirror(self, account):
+		full_refresh = self.config['lexoffice'].get('mirror_full_refresh', MIRROR_FULL_REFRESH)
+		last = self.mirror.last_full_refresh(account.financial_account_id)
+
+		if last is None or time.time() - last > full_refresh:
+			transactions = self.c.iter_financial_transactions(financial_account_id=account.financial_account_id)
+			return self.mirror.replace(account.financial_account_id, transactions, lexoffice_transaction_key, transaction_date)
+
+		## Importierte Umsätze können zwischen bekannten einsortiert sein, deshalb ihren Datumsbereich
+		## (bis zu den neuesten) neu laden
+		stale = self.mirror.stale_since(account.financial_account_id)
+		if stale is not None:
+			since = stale - datetime.timedelta(days=SYNC_DATE_SLACK)
+			transactions = self.c.iter_financial_transactions(financial_account_id=account.financial_account_id, since=since)
+			return self.mirror.replace_window(account.financial_account_id, transactions, lexoffice_transaction_key, transaction_date, since)
+
+		transactions = self.c.iter_financial_transactions(financial_account_id=account.financial_account_id)
+		page_size = self.config['lexoffice'].get('transaction_page_size', TRANSACTION_PAGE_SIZE)
+		return self.mirror.update(account.financial_account_id, transactions, lexoffice_transaction_key, transaction_date, page_size)
+
+	def missing_transactions(self, account, transactions):
+		"""Kreditkartenumsätze, die (in dieser Anzahl) noch nicht in lexoffice sind."""
+		self.refresh_mirror(account)
+
+		keys = [self.mirror.encode_key(card_transaction_key(transaction)) for transaction in transactions]
+		known = self.mirror.counts(account.financial_account_id, keys)
+		seen = collections.Counter()
+		missing = []
+		for transaction, key in zip(transactions, keys):
+			seen[key] += 1
+			if seen[key] > known[key]:
+				missing.append(transaction)
+		return missing
 
 	def upload_credit_transactions(self, account, transactions):
+		jobs = self.submit_imports(account, transactions)
+		results = self.wait_for_imports(jobs)
+
+		for status in results.values():
+			if status not in ("PENDING", "DONE"):
+				raise IOError("Unerwartete Abschluss-Antwort von der Import-API: {0}".format(status))
+		return "PENDING" if "PENDING" in results.values() else "DONE"
+
+	def submit_imports(self, account, transactions):
+		"""Stößt den Import in Teilen von höchstens lexoffice.import_chunk_size Umsätzen an,
+		damit auch große Nachträge innerhalb der Import-Zeitgrenze von lexoffice bleiben.
+		Die Teile laufen nacheinander: hier wird nur der erste angestoßen, jeden weiteren
+		stößt wait_for_imports() an, sobald der vorige fertig ist. Was bis zum Ende des
+		Laufs nicht angestoßen ist, fehlt beim nächsten Abgleich noch und wird dann importiert.
+		Liefert die zu verfolgenden ImportJobs."""
+		chunk_size = self.config['lexoffice'].get('import_chunk_size', IMPORT_CHUNK_SIZE)
+		if not isinstance(chunk_size, int) or chunk_size < 1:
+			raise ValueError("lexoffice.import_chunk_size muss mindestens 1 sein, nicht {0!r}".format(chunk_size))
+
+		chunks = [transactions[i:i+chunk_size] for i in range(0, len(transactions), chunk_size)]
+		parts = [ ("{0}von{1}".format(i, len(chunks)) if len(chunks) > 1 else None, chunk) for i, chunk in enumerate(chunks, 1) ]
+
+		job = self.submit_parts(account, parts)
+		return [job] if job is not None else []
+
+	def submit_parts(self, account, parts, root=None):
+		"""Stößt Import-Teile (part, Umsätze) an, bis einer nicht sofort fertig ist. Dessen
+		ImportJob kommt zurück, die übrigen Teile merkt sich wait_for_imports() vor.
+		root ist der erste Import der Kette, unter dem wait_for_imports() das Gesamtergebnis meldet."""
+		while parts:
+			(part, chunk), parts = parts[0], parts[1:]
+			job = self.submit_import(account, chunk, part)
+			self.logger.info("Import-Teil %s für Konto %s mit %d Umsätzen angestoßen", part or "1von1", account, len(chunk))
+
+			if job is not None:
+				if root is not None:
+					self._chain_roots[job.import_id] = root
+				if parts:
+					self._followups[job.import_id] = (account, parts)
+				return job
+
+		return None
+
+	def submit_import(self, account, transactions, part=None):
 		## Der Flow ist folgendermaßen:
 		##  File hochladen, id bekommen
-		##  Import-Settings für den Account mit PUT setzen (für *alle* Imports in diesen Account)
+		##  Import-Settings für den Account mit PUT setzen (für *alle* Imports in diesen Account), nur wenn geändert
 		##  Import anstoßen, Import-ID bekommen
-		##  Import-Ende pollen, Antwort auswerten
-
-		with io.StringIO() as fp:
-			writer = csv.writer(fp, delimiter=";")
-			for transaction in transactions:
-				purpose = transaction.mainDescription.strip()
-				if transaction.additionalDescription.strip():
-					purpose = "{0} / {1}".format(purpose, transaction.additionalDescription.strip())
-
-				writer.writerow( 
-					[account.card_no,
-						transaction.postingDate,
-						transaction.purchaseDate,
-						purpose,
-						"", "",   # Fremdwährung und Kurs
-						transaction.signed_amount.replace('+','')]
-				)
+		## Das Import-Ende verfolgt wait_for_imports(), hier kommt der ImportJob zurück (None wenn schon fertig)
 
-				csv_data = fp.getvalue().encode("UTF-8")
+		filename = "Kreditkartenumsätze_{0}_{1:%Y-%m-%d_%H-%M-%S}{2}.csv".format(str(account.card_no)[-4:], datetime.datetime.utcnow(),
+			"_Teil{0}".format(part) if part else "")
 
-		filename = "Kreditkartenumsätze_{0}_{1:%Y-%m-%d_%H-%M-%S}.csv".format(str(account.card_no)[-4:], datetime.datetime.utcnow())
-		response = self.c.upload_csv_data(filename, csv_data)
+		with spooled_file() as csv_data:
+			write_transactions_csv(account, transactions, csv_data)
+			response = self.c.upload_csv_data(filename, csv_data)
 
 		if not 'id' in response:
 			raise IOError("Unerwartete Antwort von der Upload-API: {0}".format(pprint.pformat(response)))
 
 		upload_id = response['id']
 
-		## Fixe Import-Settings
-		settings = {
-			"characterSet": "UTF-8",
-			"delimiter": "Semicolon",
-			"quoteCharacter": "DoubleQuote",
-			"negateAmount": False,
-			"fieldMappings": [
-				{"columnIndex": 2, "fieldName": "ValueDate"},
-				{"columnIndex": 3, "fieldName": "Purpose"},
-				{"columnIndex": 6, "fieldName": "Amount"},
-			]
-		}
-		
-		response = self.c.csv_preview(upload_id)
-
-		response = self.c.put_importprofile(account, settings)
+		## Die Vorschau ändert nichts und ist nur zur Diagnose interessant
+		if self.config['lexoffice'].get('csv_preview', False):
+			self.logger.debug("CSV-Vorschau für %s: %s", filename, pprint.pformat(self.c.csv_preview(upload_id)))
+
+		## Das Import-Profil nur setzen, wenn es sich geändert hat oder lexoffice den Import ablehnt
+		profile_sent = False
+		if not self.profiles.is_current(account.financial_account_id, IMPORT_SETTINGS):
+			self.put_importprofile(account)
+			profile_sent = True
+
+		try:
+			response = self.start_import(account, upload_id, filename)
+		except Exception as e:
+			## Nur bei einer echten Ablehnung, nach einem Timeout o.ä. kann der Import schon laufen
+			if profile_sent or not (isinstance(e, ImportRejected) or is_permanent_error(e)):
+				raise
+			self.logger.warning("Import für Konto %s abgelehnt (%s), Import-Profil wird neu gesetzt", account, e)
+			self.put_importprofile(account)
+			response = self.start_import(account, upload_id, filename)
+
+		dates = [transaction_date({'dateLocalized': transaction.purchaseDate}) for transaction in transactions]
+		since = min(dates) if dates and None not in dates else None
+
+		if response.get('status', '') == "DONE":
+			if self.mirror is not None:
+				self.mirror.mark_stale(account.financial_account_id, since)
+			return None
+
+		job = self.imports.add(response['financialTransactionImportId'], account.financial_account_id, filename)
+		if self.mirror is not None:
+			self.mirror.expect_import(job.import_id, account.financial_account_id, since)
+		return job
+
+	def start_import(self, account, upload_id, filename):
+		response = self.c.do_import(account, upload_id, filename)
+		if response.get('status', '') not in ("PENDING", "DONE"):
+			raise ImportRejected("Unerwartete Antwort von der Import-API: {0}".format(pprint.pformat(response)))
+		return response
+
+	def put_importprofile(self, account):
+		self.profiles.clear(account.financial_account_id)
+		response = self.c.put_importprofile(account, IMPORT_SETTINGS)
 		if not response.get("statusType", "") == "OK":
 			raise IOError("Unerwartete Antwort von der Import-Profil-API: {0}".format(pprint.pformat(response)))
+		self.profiles.set(account.financial_account_id, IMPORT_SETTINGS)
+
+	def wait_for_imports(self, jobs=None, deadline=None):
+		"""Verfolgt die Importe (ohne jobs: alle offenen, auch aus früheren Läufen) gemeinsam
+		bis zum Ende oder bis deadline Sekunden vergangen sind. Der Abfrageabstand wächst
+		je Import. Liefert import_id -> Status, "PENDING" für die, die der nächste Lauf weiter verfolgt."""
+		if jobs is None:
+			jobs = self.imports.pending()
+		if deadline is None:
+			deadline = self.config['lexoffice'].get('import_deadline', IMPORT_DEADLINE)
+
+		end = time.time() + deadline
+		pending = dict( (job.import_id, job) for job in jobs )
+		interval = dict( (import_id, IMPORT_POLL_MIN) for import_id in pending )
+		due = dict( (import_id, time.time()) for import_id in pending )
+		results = {}
+
+		while pending:
+			for import_id in [i for i in pending if due[i] <= time.time()]:
+				try:
+					status = self.c.get_importstate(import_id).get('status', '')
+				except Exception as e:
+					if not is_permanent_error(e):
+						self.logger.warning("Status von Import %s nicht abrufbar (%s)", import_id, e)
+						status = "PENDING"
+					else:
+						self.logger.exception("Status von Import {0} nicht abrufbar".format(import_id))
+						status = "UNKNOWN"
+
+				if status == "PENDING":
+					interval[import_id] = min(IMPORT_POLL_MAX, interval[import_id] * IMPORT_POLL_FACTOR)
+					due[import_id] = time.time() + interval[import_id] * random.uniform(0.8, 1.2)
+					continue
+
+				if status == "DONE":
+					self.logger.info("Import %s (%s) abgeschlossen", import_id, pending[import_id].description)
+				else:
+					self.logger.error("Import %s (%s) mit Status %r beendet", import_id, pending[import_id].description, status)
+					## Beim nächsten Import das Profil sicherheitshalber neu setzen
+					self.profiles.clear(pending[import_id].financial_account_id)
+
+				results[import_id] = status
+				self.imports.remove(import_id)
+				if self.mirror is not None:
+					self.mirror.import_finished(import_id, status == "DONE")
+				job = pending.pop(import_id)
+
+				root = self._chain_roots.pop(import_id, import_id)
+				followup = self._followups.pop(import_id, None)
+				if followup is not None and status == "DONE":
+					account, parts = followup
+					try:
+						job = self.submit_parts(account, parts, root)
+					except Exception:
+						self.logger.exception("Weiterer Import-Teil für Konto {0} fehlgeschlagen".format(account))
+						status = "ERROR"
+					else:
+						if job is not None:
+							pending[job.import_id] = job
+							interval[job.import_id] = IMPORT_POLL_MIN
+							due[job.import_id] = time.time()
+							continue
 
-		response = self.c.do_import(account, upload_id, filename)
-		if response.get('status', '') not in ("PENDING", "DONE"):
-			raise IOError("Unerwartete Antwort von der Import-API: {0}".format(pprint.pformat(response)))
+				## Für den ersten Import einer Kette zählt das Ergebnis der ganzen Kette
+				results[root] = status
 
-		for i in range(10):
-			if response.get('status', '') == "DONE":
+			if not pending:
 				break
 
-			time.sleep(3)
-			response = self.c.get_importstate(response['financialTransactionImportId'])
-			
-			if response.get('status', '') not in ("PENDING", "DONE"):
-				raise IOError("Unerwartete Abschluss-Antwort von der Import-API: {0}".format(pprint.pformat(response)))
+			next_due = min(due[import_id] for import_id in pending)
+			if next_due > end:
+				break
+			time.sleep(max(0, next_due - time.time()))
+
+		for import_id, job in pending.items():
+			self.logger.warning("Import %s (%s) nach %d Sekunden nicht abgeschlossen, wird beim nächsten Lauf weiter verfolgt",
+				import_id, job.description, time.time() - job.submitted_at)
+			results[import_id] = "PENDING"
+			results[self._chain_roots.get(import_id, import_id)] = "PENDING"
+			if import_id in self._followups:
+				self.logger.warning("Restliche Import-Teile für Konto %s folgen beim nächsten Abgleich", self._followups[import_id][0])
+
+		return results
 
-		return response.get('status', '')
+
+class SyncResult(collections.namedtuple('SyncResult', ['manager', 'account', 'jobs', 'error', 'seconds', 'imports', 'skipped'])):
+	"""Ergebnis des Abgleichs eines Kontos, imports (import_id -> Status) erst nach with_import_statuses().
+	skipped, wenn das Konto wegen eines noch laufenden früheren Imports nicht abgeglichen wurde."""
+	__slots__ = ()
+
+	def with_import_statuses(self, statuses):
+		return self._replace(imports=dict( (job.import_id, statuses.get(job.import_id, "PENDING")) for job in self.jobs or [] ))
+
+	@property
+	def failed(self):
+		## PENDING ist kein Fehler, solche Importe verfolgt der nächste Lauf weiter
+		return self.error is not None or any(status not in ("DONE", "PENDING") for status in (self.imports or {}).values())
+
+	@property
+	def carried_over(self):
+		"""Anzahl der Importe, die der nächste Lauf weiter verfolgt."""
+		return sum(1 for status in (self.imports or {}).values() if status == "PENDING")
+
+def sync_credit_accounts(tasks, workers=SYNC_WORKERS):
+	"""Gleicht (manager, account, transactions) parallel mit höchstens workers Threads ab
+	und stößt die Importe an (wait=False). Ein Fehler bei einem Konto hält die anderen
+	nicht auf. Liefert je Konto ein SyncResult in der Reihenfolge von tasks."""
+	def sync(manager, account, transactions):
+		start = time.time()
+		try:
+			jobs = manager.sync_credit_transactions(account, transactions, wait=False)
+		except Exception as e:
+			manager.logger.exception("Abgleich von Konto {0} fehlgeschlagen".format(account))
+			return SyncResult(manager, account, None, e, time.time() - start, None, False)
+		if jobs is SKIPPED:
+			return SyncResult(manager, account, None, None, time.time() - start, None, True)
+		return SyncResult(manager, account, jobs, None, time.time() - start, None, False)
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="Sync") as executor:
+		futures = [executor.submit(sync, manager, account, transactions) for manager, account, transactions in tasks]
+		return [future.result() for future in futures]
+
+def wait_for_all_imports(managers, deadline=None):
+	"""Verfolgt die Importe aller manager gleichzeitig, insgesamt also höchstens eine
+	deadline lang. Liefert import_id -> Status wie wait_for_imports()."""
+	results = {}
+	if not managers:
+		return results
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=len(managers), thread_name_prefix="Imports") as executor:
+		for statuses in executor.map(lambda manager: manager.wait_for_imports(deadline=deadline), managers):
+			results.update(statuses)
+	return results
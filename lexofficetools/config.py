@@ -3,6 +3,7 @@ import yaml
 
 CONFIG_DEFAULTS = {
 	"lexofficeInstance": "app.lexoffice.de",
+	"lexofficeScheme": "https",
 }
 
 class ConfigParseError(Exception): pass
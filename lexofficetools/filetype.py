@@ -0,0 +1,40 @@
+import struct
+
+## Erkennung der Dateitypen, die hochgeladen werden, nur anhand der ersten Bytes.
+## (Präfix, Typ), geprüft in dieser Reihenfolge
+SIGNATURES = [
+	(b"%PDF-", 'application/pdf'),
+	(b"\n%PDF-", 'application/pdf'),
+	(b"\xef\xbb\xbf%PDF-", 'application/pdf'),
+	(b"\xff\xd8\xff", 'image/jpeg'),
+	(b"\x89PNG\r\n\x1a\n", 'image/png'),
+	(b"PK\x03\x04", 'application/zip'),
+	(b"PK\x05\x06", 'application/zip'),
+	(b"PK\x07\x08", 'application/zip'),
+]
+
+## ZIP-Container mit diesen ersten Einträgen sind Office-Dokumente, JARs etc.
+## und sollen nicht als ZIP-Archiv entpackt werden
+ZIP_CONTAINER_NAMES = [b"mimetype", b"[Content_Types].xml", b"_rels/", b"META-INF/", b"word/", b"xl/", b"ppt/"]
+
+UNKNOWN = 'application/octet-stream'
+
+def is_container_zip(head):
+	if head.startswith(b"PK\x03\x04") and len(head) >= 30:
+		name_length, = struct.unpack("<H", head[26:28])
+		name = head[30:30+name_length]
+		if any(name.startswith(prefix) for prefix in ZIP_CONTAINER_NAMES):
+			return True
+
+	return b"[Content_Types].xml" in head
+
+def detect_type(head):
+	"""Liefert den MIME-Typ anhand der Signatur in head, UNKNOWN wenn keine passt,
+	und None wenn die Signatur mehrdeutig ist und libmagic entscheiden muss."""
+	for prefix, ctype in SIGNATURES:
+		if head.startswith(prefix):
+			if ctype == 'application/zip' and is_container_zip(head):
+				return None
+			return ctype
+
+	return UNKNOWN
@@ -0,0 +1,85 @@
+import logging
+import os.path
+
+try:
+	from PIL import Image, ImageOps
+except ImportError:
+	Image = None
+
+from .metrics import IMAGE_SECONDS
+from .spool import SPOOL_THRESHOLD, spooled_file, payload_size
+
+## Voreinstellungen für imap.images, max_dimension entspricht etwa A4 mit 300 dpi
+IMAGE_DEFAULTS = {
+	"max_dimension": 3508,
+	"quality": 85,
+	"min_size": 1024*1024,
+	"convert_png": False,
+}
+
+IMAGE_TYPES = ['image/jpeg', 'image/png']
+
+class ImageTransformer(object):
+	"""Verkleinert und rekomprimiert große Bilder vor dem Hochladen. Das läuft im Thread
+	des Aufrufers. ImapReceiver arbeitet mit imap.images immer mit mindestens einem
+	Upload-Worker, die Bilder werden also parallel in den imap.upload_workers verkleinert
+	und nicht im IMAP-Thread. Pillow gibt dabei das GIL frei."""
+	def __init__(self, options, name=None, spool_threshold=SPOOL_THRESHOLD):
+		if Image is None:
+			raise ImportError("Für imap.images wird Pillow benötigt (pip install lexofficetools[images])")
+
+		self.options = dict(IMAGE_DEFAULTS)
+		if isinstance(options, dict):
+			self.options.update(options)
+
+		self.name = name
+		self.spool_threshold = spool_threshold
+		self.logger = logging.getLogger('lexofficetools.images[{0}]'.format(name))
+
+	def transform(self, name, ctype, data):
+		"""Liefert (name, ctype, data) für den Upload. Wurde das Bild verkleinert, ist data
+		eine neue Datei, die der Aufrufer schließen muss, sonst die übergebene."""
+		if ctype not in IMAGE_TYPES or payload_size(data) < self.options["min_size"]:
+			return name, ctype, data
+
+		with IMAGE_SECONDS.time(configuration=self.name, result="error") as labels:
+			target = 'image/jpeg' if self.options["convert_png"] else ctype
+			result = spooled_file(self.spool_threshold)
+
+			try:
+				with Image.open(data) as original:
+					## Drehung aus den EXIF-Daten übernehmen, die Metadaten selbst werden nicht mitgespeichert
+					image = ImageOps.exif_transpose(original)
+					image.thumbnail((self.options["max_dimension"], self.options["max_dimension"]), Image.LANCZOS)
+					icc_profile = original.info.get("icc_profile")
+
+					if target == 'image/jpeg':
+						if image.mode not in ("RGB", "L"):
+							image = image.convert("RGBA")
+							flattened = Image.new("RGB", image.size, (255, 255, 255))
+							flattened.paste(image, mask=image.getchannel("A"))
+							image = flattened
+						image.save(result, "JPEG", quality=self.options["quality"], optimize=True, icc_profile=icc_profile)
+					else:
+						image.save(result, "PNG", optimize=True, icc_profile=icc_profile)
+
+			except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+				self.logger.warning("Bild %r konnte nicht verkleinert werden (%s), wird unverändert hochgeladen", name, e)
+				result.close()
+				data.seek(0)
+				return name, ctype, data
+
+			data.seek(0)
+			if payload_size(result) >= payload_size(data):
+				labels["result"] = "unchanged"
+				result.close()
+				return name, ctype, data
+
+			labels["result"] = "transformed"
+			self.logger.info("Bild %r von %d auf %d Bytes verkleinert", name, payload_size(data), payload_size(result))
+			result.seek(0)
+
+			if target != ctype and name:
+				name = os.path.splitext(name)[0] + ".jpg"
+
+			return name, target, result
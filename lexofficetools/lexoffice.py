@@ -2,94 +2,342 @@ import requests
 import json
 import os.path
 import time
+import io
+import binascii
+from urllib3.fields import RequestField
+import threading
+import random
+import logging
+import datetime
+import functools
+import concurrent.futures
+
+from .metrics import LEXOFFICE_SECONDS, LEXOFFICE_LOGINS, LEXOFFICE_RETRIES, LEXOFFICE_THROTTLE_SECONDS
+from .state import SessionCache, RateLimiter
 
 URLS = {
-	'login': 'https://{lexofficeInstance}/grld-public/login/authorize',
-	'logout': 'https://{lexofficeInstance}/grld-public/login/v100/logout',
-	'privilege': 'https://{lexofficeInstance}/grld-rest/privilege-management/v100/privilege',
-	'uploadBookkeepingVoucherImage': 'https://{lexofficeInstance}/grld-rest/voucherimageservice/1/v101/uploadBookkeepingVoucherImage/',
-	'financialAccounts': 'https://{lexofficeInstance}/grld-rest/financialaccountservice/v100/financialAccounts',
-	'financialTransactions': 'https://{lexofficeInstance}/grld-rest/financialtransactionservice/v100/financialTransactions',
-	'uploadCsvFile': 'https://{lexofficeInstance}/grld-upload-rest/uploadNtService/v100/uploadCsvFile/',
-	'put_importprofile': 'https://{lexofficeInstance}/grld-rest/importprofileservice/v100/importprofile/financialAccount/{financial_account_id}',
-	'import': 'https://{lexofficeInstance}/grld-rest/financialtransactionimportservice/v100/import',
-	'get_importstate': 'https://{lexofficeInstance}/grld-rest/financialtransactionimportservice/v100/importState/{financial_transaction_import_id}',
-	'csvPreview': 'https://{lexofficeInstance}/grld-rest/financialtransactionimportservice/v100/csvPreview',
+	'login': '{lexofficeScheme}://{lexofficeInstance}/grld-public/login/authorize',
+	'logout': '{lexofficeScheme}://{lexofficeInstance}/grld-public/login/v100/logout',
+	'privilege': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/privilege-management/v100/privilege',
+	'uploadBookkeepingVoucherImage': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/voucherimageservice/1/v101/uploadBookkeepingVoucherImage/',
+	'financialAccounts': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/financialaccountservice/v100/financialAccounts',
+	'financialTransactions': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/financialtransactionservice/v100/financialTransactions',
+	'uploadCsvFile': '{lexofficeScheme}://{lexofficeInstance}/grld-upload-rest/uploadNtService/v100/uploadCsvFile/',
+	'put_importprofile': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/importprofileservice/v100/importprofile/financialAccount/{financial_account_id}',
+	'import': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/financialtransactionimportservice/v100/import',
+	'get_importstate': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/financialtransactionimportservice/v100/importState/{financial_transaction_import_id}',
+	'csvPreview': '{lexofficeScheme}://{lexofficeInstance}/grld-rest/financialtransactionimportservice/v100/csvPreview',
 }
 
 USER_AGENT = 'GITHUB_COM_HENRYK_LEXOFFICE_BELEGMAIL/43'
 
+## Voreinstellungen für die Transport-Optionen unter lexoffice. rate_limit (Anfragen pro
+## Sekunde, mit rate_burst) gilt gemeinsam für alle Prozesse, die dieselbe lexofficeInstance benutzen.
+TRANSPORT_DEFAULTS = {
+	"retries": 3,
+	"backoff": 0.5,
+	"max_backoff": 30,
+	"timeout": (10, 300),
+	"pool_size": 10,
+	"rate_limit": None,
+	"rate_burst": None,
+}
+
+## Seitengröße beim Abruf der Umsätze, überschreibbar mit lexoffice.transaction_page_size
+TRANSACTION_PAGE_SIZE = 60
+
+## Diese Aufrufe dürfen auch nach einer Antwort mit 5xx oder einem Abbruch wiederholt werden
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+IDEMPOTENT_ENDPOINTS = ('login', 'csvPreview')
+
+## Bei diesen Status hat lexoffice die Anfrage sicher nicht ausgeführt
+RETRY_ALWAYS = (429, 503)
+RETRY_IDEMPOTENT = (500, 502, 504)
+
+def is_permanent_error(exc):
+	"""Ob ein Fehler beim Aufruf von lexoffice auch bei Wiederholung bestehen bleibt."""
+	if isinstance(exc, requests.HTTPError) and exc.response is not None:
+		status = exc.response.status_code
+		return 400 <= status < 500 and status not in (401, 403, 408, 429)
+	return isinstance(exc, FileNotFoundError)
+
+def account_key(configuration):
+	"""Kennung des lexoffice-Kontos einer Konfiguration, um lokalen Zustand zuzuordnen."""
+	lexoffice = configuration['lexoffice']
+	if 'account' in lexoffice:
+		return "{0}/{1}".format(configuration['lexofficeInstance'], lexoffice['account'])
+
+	auth = sorted( (k, v) for (k, v) in lexoffice['auth'].items() if 'pass' not in k.lower() )
+	return "{0}/{1}".format(configuration['lexofficeInstance'], json.dumps(auth))
+
+class MultipartStream(object):
+	"""multipart/form-data-Body, der beim Senden stückweise gelesen wird.
+
+	params hat das Format von requests' files=-Parameter, die Daten dürfen bytes,
+	str oder Dateiobjekte sein. Dateien werden erst beim Senden gelesen."""
+	def __init__(self, params):
+		self.boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+		self.content_type = 'multipart/form-data; boundary={0}'.format(self.boundary)
+		self._parts = []
+
+		for name, (filename, data, content_type) in params.items():
+			field = RequestField(name=name, data=b'', filename=filename)
+			field.make_multipart(content_type=content_type)
+			self._parts.append( "--{0}\r\n{1}".format(self.boundary, field.render_headers()).encode('utf-8') )
+			if isinstance(data, str):
+				data = data.encode('utf-8')
+			self._parts.append(data)
+			self._parts.append(b'\r\n')
+		self._parts.append( "--{0}--\r\n".format(self.boundary).encode('utf-8') )
+
+		self._positions = [part.tell() for part in self._parts if not isinstance(part, bytes)]
+		self.rewind()
+
+	def rewind(self):
+		"""Setzt den Body an den Anfang zurück, z.B. um den Request zu wiederholen."""
+		positions = iter(self._positions)
+		for part in self._parts:
+			if not isinstance(part, bytes):
+				part.seek(next(positions))
+		self._current = 0
+		self._offset = 0
+
+	def __len__(self):
+		length = 0
+		positions = iter(self._positions)
+		for part in self._parts:
+			if isinstance(part, bytes):
+				length = length + len(part)
+			else:
+				position = part.tell()
+				length = length + part.seek(0, io.SEEK_END) - next(positions)
+				part.seek(position)
+		return length
+
+	def read(self, size=-1):
+		result = []
+		while self._current < len(self._parts) and (size < 0 or size > 0):
+			part = self._parts[self._current]
+			if isinstance(part, bytes):
+				chunk = part[self._offset:] if size < 0 else part[self._offset:self._offset+size]
+				self._offset = self._offset + len(chunk)
+				done = self._offset >= len(part)
+			else:
+				chunk = part.read(size)
+				done = not chunk or size < 0
+
+			result.append(chunk)
+			if size > 0:
+				size = size - len(chunk)
+			if done:
+				self._current = self._current + 1
+				self._offset = 0
+
+		return b"".join(result)
+
+def transaction_date(item):
+	"""Datum eines lexoffice-Umsatzes als datetime.date, None wenn unbekannt."""
+	try:
+		return datetime.datetime.strptime(item['dateLocalized'], '%d.%m.%Y').date()
+	except (KeyError, TypeError, ValueError):
+		return None
+
+def retry_after(response):
+	"""Wartezeit aus dem Retry-After-Header in Sekunden, None wenn nicht (als Zahl) angegeben."""
+	try:
+		return max(0.0, float(response.headers.get('Retry-After')))
+	except (TypeError, ValueError):
+		return None
+
 class RestClientUser(object):
 	def __init__(self, configuration):
 		self.c = None
 		self.config = configuration
-		self._last_login = None
+		self._login_lock = threading.Lock()
 
 	def ensure_login(self):
-		# FIXME Better logic
-		if not self.c or not self._last_login:
-			self.c = RestClient(self.config)
-			self.c.login()
-			self._last_login = time.time()
-		else:
-			delta = time.time() - self._last_login
-			if delta < 0 or delta > 60*60:
-				## Assume a re-login is necessary after 60 minutes
-				self.c.login()
+		## Abgelaufene Sitzungen erneuert RestClient selbst, sobald lexoffice mit 401/403 antwortet
+		with self._login_lock:
+			if not self.c:
+				c = RestClient(self.config)
+				if not c.restore_session():
+					c.login()
+				self.c = c
+
 
+def export_cookies(jar):
+	return [
+		{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path,
+			"secure": cookie.secure, "expires": cookie.expires}
+		for cookie in jar
+		if cookie.expires is None or cookie.expires > time.time()
+	]
 
 class RestClient(object):
 	def __init__(self, configuration):
 		self.config = configuration
+		self.logger = logging.getLogger('lexofficetools.lexoffice[{0}]'.format(configuration.name))
 		self.session = None
+		## Die Cookies liegen im Klartext in der Zustandsdatenbank, deshalb nur auf Wunsch
+		self.sessions = None
+		if configuration['lexoffice'].get('session_cache', False):
+			self.sessions = SessionCache()
+		self._login_lock = threading.RLock()
+		self._generation = 0
+
+		self.transport = dict(TRANSPORT_DEFAULTS)
+		self.transport.update( (k, v) for (k, v) in configuration['lexoffice'].items() if k in TRANSPORT_DEFAULTS )
+
+		self.limiter = None
+		if self.transport["rate_limit"]:
+			self.limiter = RateLimiter(configuration['lexofficeInstance'], self.transport["rate_limit"], self.transport["rate_burst"])
 
 	def ensure_session(self):
 		if not self.session:
 			self.session = requests.Session()
 			self.session.headers.update({'User-Agent': USER_AGENT})
 
+			## Keep-Alive-Verbindungen für alle Threads, die sich diesen Client teilen
+			adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.transport["pool_size"])
+			self.session.mount('https://', adapter)
+			self.session.mount('http://', adapter)
+
 	def get_url(self, endpoint, **kwargs):
 		values = dict(**self.config)
 		values.update(kwargs)
 		return URLS[endpoint].format(**values)
 
-	def json_api_post(self, endpoint, params):
+	def request(self, method, endpoint, url_params={}, **kwargs):
 		self.ensure_session()
-		r = self.session.post(self.get_url(endpoint), json=params)
+		kwargs.setdefault('timeout', tuple(self.transport["timeout"]))
+		generation = self._generation
+		r = self._send_retrying(method, endpoint, url_params, **kwargs)
+
+		if r.status_code in (401, 403) and endpoint != 'login':
+			## Sitzung abgelaufen (oder aus dem Cache veraltet): neu anmelden und einmal wiederholen
+			self.refresh_login(generation)
+			r = self._send_retrying(method, endpoint, url_params, **kwargs)
+
 		r.raise_for_status()
-		return r.json()
+		return r
+
+	def _send_retrying(self, method, endpoint, url_params, session=None, **kwargs):
+		idempotent = method in IDEMPOTENT_METHODS or endpoint in IDEMPOTENT_ENDPOINTS
+		attempt = 0
+
+		while True:
+			if hasattr(kwargs.get('data'), 'rewind'):
+				kwargs['data'].rewind()
+
+			try:
+				r = self._send(method, endpoint, url_params, session, **kwargs)
+
+			except (requests.ConnectionError, requests.Timeout) as e:
+				## Bei ConnectTimeout ist sicher nichts angekommen, sonst nur idempotent wiederholen
+				if attempt >= self.transport["retries"] or not (idempotent or isinstance(e, requests.exceptions.ConnectTimeout)):
+					raise
+				reason, delay = e.__class__.__name__, self.backoff(attempt)
+
+			else:
+				if attempt >= self.transport["retries"]:
+					return r
+				if not (r.status_code in RETRY_ALWAYS or (idempotent and r.status_code in RETRY_IDEMPOTENT)):
+					return r
+				reason, delay = str(r.status_code), retry_after(r)
+				if delay is None:
+					delay = self.backoff(attempt)
+				delay = min(self.transport["max_backoff"], delay)
+				r.close()
+
+			LEXOFFICE_RETRIES.inc(endpoint=endpoint, reason=reason)
+			self.logger.warning("lexoffice-Aufruf %s fehlgeschlagen (%s), neuer Versuch in %.1f Sekunden", endpoint, reason, delay)
+			time.sleep(delay)
+			attempt = attempt + 1
+
+	def backoff(self, attempt):
+		return min(self.transport["max_backoff"], self.transport["backoff"] * 2**attempt) * random.uniform(0.5, 1.0)
+
+	def _send(self, method, endpoint, url_params, session=None, **kwargs):
+		if self.limiter is not None:
+			delay = self.limiter.acquire()
+			if delay:
+				LEXOFFICE_THROTTLE_SECONDS.inc(delay, instance=self.config['lexofficeInstance'])
+
+		with LEXOFFICE_SECONDS.time(endpoint=endpoint, status="error") as labels:
+			r = (session or self.session).request(method, self.get_url(endpoint, **url_params), **kwargs)
+			labels["status"] = r.status_code
+		return r
+
+	def refresh_login(self, generation):
+		"""Meldet neu an, außer ein anderer Thread hat das seit generation schon getan."""
+		with self._login_lock:
+			if generation == self._generation:
+				self.login()
+
+	def json_api_post(self, endpoint, params):
+		return self.request('POST', endpoint, json=params).json()
 
 	def json_api_get(self, endpoint, params=None, url_params={}):
-		self.ensure_session()
-		r = self.session.get(self.get_url(endpoint, **url_params), params=params)
-		r.raise_for_status()
-		return r.json()
+		return self.request('GET', endpoint, url_params, params=params).json()
 
 	def json_api_put(self, endpoint, params, url_params={}):
-		self.ensure_session()
-		r = self.session.put(self.get_url(endpoint, **url_params), json=params)
-		r.raise_for_status()
-		return r.json()
+		return self.request('PUT', endpoint, url_params, json=params).json()
 
 	def json_api_multipart(self, endpoint, params):
-		self.ensure_session()
-		r = self.session.post(self.get_url(endpoint), files=params)
-		r.raise_for_status()
-		return r.json()
+		body = MultipartStream(params)
+		return self.request('POST', endpoint, data=body, headers={'Content-Type': body.content_type}).json()
 
 	def login(self):
-		return self.json_api_post('login', self.config['lexoffice']['auth'])
+		"""Meldet in einer eigenen Session ohne Cookies an und übernimmt erst danach deren
+		Cookies. Anfragen anderer Threads laufen bis dahin mit der alten Sitzung weiter."""
+		self.ensure_session()
+		with self._login_lock:
+			login_session = requests.Session()
+			login_session.headers.update(self.session.headers)
+			for prefix, adapter in self.session.adapters.items():
+				login_session.mount(prefix, adapter)
+
+			r = self._send_retrying('POST', 'login', {}, session=login_session,
+				json=self.config['lexoffice']['auth'], timeout=tuple(self.transport["timeout"]))
+			r.raise_for_status()
+			result = r.json()
+
+			self.session.cookies = login_session.cookies
+			self._generation = self._generation + 1
+			LEXOFFICE_LOGINS.inc(configuration=self.config.name)
+
+			if self.sessions is not None:
+				self.sessions.save(self.config.name, account_key(self.config), export_cookies(self.session.cookies))
+		return result
+
+	def restore_session(self):
+		"""Übernimmt die Cookies einer früheren Sitzung, True wenn es welche gab."""
+		if self.sessions is None:
+			return False
+
+		cookies = self.sessions.load(self.config.name, account_key(self.config))
+		if not cookies:
+			return False
+
+		self.ensure_session()
+		for cookie in cookies:
+			self.session.cookies.set(**cookie)
+		return True
 
 	def logout(self):
-		return self.json_api_get('logout')
+		result = self.json_api_get('logout')
+		if self.sessions is not None:
+			self.sessions.clear(self.config.name)
+		return result
 
 	def privilege(self):
 		return self.json_api_get('privilege')
 
 	def upload_image(self, filename, data = None, content_type='application/octet-stream'):
+		"""data kann bytes oder ein Dateiobjekt sein, ohne data wird die Datei filename hochgeladen."""
 		if not data:
 			with open(filename, "rb") as fp:
-				data = fp.read()
+				return self.upload_image(filename, fp, content_type)
 
 		params = {
 			"file": (os.path.basename(filename), data, content_type),
@@ -144,3 +392,33 @@ class RestClient(object):
 		if financial_account_id is not None:
 			params['financialAccountId'] = financial_account_id
 		return self.json_api_get('financialTransactions', params)
+
+	def iter_financial_transactions(self, financial_account_id=None, search_state=None, since=None, until=None, page_size=None):
+		"""Liefert alle Umsätze Seite für Seite. Die nächste Seite wird schon geholt,
+		während der Aufrufer die aktuelle bearbeitet.
+
+		since/until (datetime.date) beschränken auf das Umsatzdatum. lexoffice liefert
+		die neuesten Umsätze zuerst, deshalb endet der Abruf nach der ersten Seite,
+		die nur noch ältere Umsätze als since enthält."""
+		page_size = page_size or self.config['lexoffice'].get('transaction_page_size', TRANSACTION_PAGE_SIZE)
+		fetch = functools.partial(self.get_financial_transactions, num_rows=page_size,
+			search_state=search_state, financial_account_id=financial_account_id)
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+			first_row = 0
+			future = executor.submit(fetch, first_row)
+
+			while future is not None:
+				page = future.result()
+				first_row = first_row + len(page)
+				dates = [transaction_date(item) for item in page]
+
+				future = None
+				exhausted = since is not None and dates and all(date is not None and date < since for date in dates)
+				if len(page) >= page_size and not exhausted:
+					future = executor.submit(fetch, first_row)
+
+				for item, date in zip(page, dates):
+					if date is not None and ((since is not None and date < since) or (until is not None and date > until)):
+						continue
+					yield item
@@ -1,4 +1,5 @@
 import imapclient
+from imapclient.response_types import BodyData
 import datetime
 import email, email.utils
 import enum
@@ -6,11 +7,22 @@ import magic
 import io
 import zipfile
 import logging
+import queue
+import threading
+import time
+import random
+import contextlib
+import collections
 from signal import SIGINT, SIGTERM
 from pysigset import suspended_signals
 from email.header import decode_header
 
-from .lexoffice import RestClientUser
+from .lexoffice import RestClientUser, account_key, is_permanent_error
+from .state import UploadLedger, MailboxCheckpoints, Outbox
+from .metrics import IMAP_FETCH_SECONDS, MESSAGES, ATTACHMENTS, ATTACHMENT_BYTES, SNIFF_SECONDS
+from .filetype import detect_type
+from .images import ImageTransformer
+from .spool import SPOOL_THRESHOLD, spooled_file, payload_size, copy_limited, decode_payload
 
 ACCEPTABLE_LIST = ['image/jpeg', 'application/pdf', 'image/png']
 ACCEPTABLE_ZIP = ['application/zip', 'application/x-zip-compressed']
@@ -18,12 +30,34 @@ ACCEPTABLE_OCTET = 'application/octet-stream'
 
 ZIP_RECURSION_LIMIT = 2
 
+## Grenzen für alle ZIP-Dateien eines Anhangs zusammen, inklusive verschachtelter ZIPs.
+## Können per imap.zip_limits überschrieben werden.
+ZIP_LIMITS = {
+	"max_members": 1000,
+	"max_member_size": 100*1024*1024,
+	"max_total_size": 250*1024*1024,
+	"max_ratio": 200,
+}
+
+SNIFF_BYTES = 8192
+
+IDLE_TIMEOUT = 300
+
+## Outbox: Wartezeiten in Sekunden. Solange Mails in der Outbox stehen, wird das
+## Postfach häufiger bearbeitet, damit erledigte Mails zeitnah verschoben werden.
+OUTBOX_BASE_DELAY = 30
+OUTBOX_MAX_DELAY = 60*60
+OUTBOX_LEASE = 15*60
+OUTBOX_POLL_INTERVAL = 10
+OUTBOX_DISPOSE_INTERVAL = 60
+
 class PROCESSING_RESULT(enum.Enum):
 	ERROR = 0
 	UPLOADED = 1
 	IGNORE = 2
 	PROCESSED = 3
 	OTHER = 4
+	QUEUED = 5
 
 def decode_header_value(data):
 	result = []
@@ -34,12 +68,256 @@ def decode_header_value(data):
 			result.append(text)
 	return "".join(result)
 
+def acceptable_sections(bodystructure, prefix=""):
+	"""Liefert die IMAP-Sektionsnummern aller Teile aus einer BODYSTRUCTURE, die
+	handle_mail als Anhang in Betracht ziehen würde."""
+	if not bodystructure.is_multipart:
+		return
+
+	for i, part in enumerate(bodystructure[0], 1):
+		section = "{0}{1}".format(prefix, i)
+
+		if part.is_multipart:
+			yield from acceptable_sections(part, section + ".")
+			continue
+
+		ctype = "{0}/{1}".format(part[0].decode('us-ascii'), part[1].decode('us-ascii')).lower()
+
+		if ctype == 'message/rfc822' and len(part) > 8 and isinstance(part[8], tuple):
+			## Nur mehrteilige eingebettete Mails, sonst ist die Sektionsnummerierung serverabhängig
+			yield from acceptable_sections(BodyData.create(part[8]), section + ".")
+		elif ctype in ACCEPTABLE_LIST + ACCEPTABLE_ZIP + [ACCEPTABLE_OCTET]:
+			yield section
+
+## libmagic ist nicht threadsicher
+_magic_lock = threading.Lock()
+
+def sniff_type(head):
+	"""Bestimmt den Typ anhand der ersten Bytes, libmagic nur bei mehrdeutigen Signaturen."""
+	with SNIFF_SECONDS.time(method="signature") as labels:
+		ctype = detect_type(head)
+		if ctype is None:
+			labels["method"] = "libmagic"
+			with _magic_lock:
+				ctype = magic.from_buffer(head, mime=True)
+		return ctype
+
+def summarize_result(results):
+	"""Fasst die Ergebnisse der einzelnen Anhänge einer Mail zusammen."""
+	for result in (PROCESSING_RESULT.ERROR, PROCESSING_RESULT.QUEUED, PROCESSING_RESULT.UPLOADED):
+		if result in results:
+			return result
+
+	return PROCESSING_RESULT.PROCESSED
+
+class PendingMail(object):
+	"""Zustand einer Mail in der Pipeline, bis alle ihre Anhänge hochgeladen sind."""
+	def __init__(self, msgid, data, key=None):
+		self.msgid = msgid
+		self.data = data
+		self.key = key
+		self.message_id = None
+		self.result = None
+		self.results = []
+		self._pending = 1  # Das Zerlegen der Mail selbst
+		self._lock = threading.Lock()
+
+	def add(self):
+		with self._lock:
+			self._pending = self._pending + 1
+
+	def done(self, result=None):
+		"""Meldet einen abgeschlossenen Arbeitsschritt, True wenn es der letzte war."""
+		with self._lock:
+			if result is not None:
+				self.results.append(result)
+
+			self._pending = self._pending - 1
+			return self._pending == 0
+
+	def get_result(self):
+		if self.result is not None:
+			return self.result
+		return summarize_result(self.results)
+
+class ZipLimitError(Exception): pass
+
+class ZipBudget(object):
+	"""Zählt Einträge und entpackte Bytes über verschachtelte ZIP-Dateien hinweg."""
+	def __init__(self, max_members, max_member_size, max_total_size, max_ratio):
+		self.max_members = max_members
+		self.max_member_size = max_member_size
+		self.max_total_size = max_total_size
+		self.max_ratio = max_ratio
+		self.members = 0
+		self.total_size = 0
+
+	def check_member(self, name, finfo):
+		self.members = self.members + 1
+		if self.members > self.max_members:
+			raise ZipLimitError("Zu viele Dateien im ZIP-Archiv: {0}".format(name))
+
+		self._check_size(name, finfo, finfo.file_size)
+
+	def check_data(self, name, finfo, size):
+		## Die Angaben im Verzeichnis können lügen, also nochmal mit den tatsächlichen Daten
+		self._check_size(name, finfo, size)
+		self.total_size = self.total_size + size
+		if self.total_size > self.max_total_size:
+			raise ZipLimitError("ZIP-Archiv entpackt zu groß: {0}".format(name))
+
+	def _check_size(self, name, finfo, size):
+		if size > self.max_member_size:
+			raise ZipLimitError("Datei im ZIP-Archiv zu groß: {0}".format(name))
+		## Kleine Dateien dürfen beliebig gut komprimiert sein
+		if size > 1024*1024 and size > max(finfo.compress_size, 1) * self.max_ratio:
+			raise ZipLimitError("Datei im ZIP-Archiv zu stark komprimiert: {0}".format(name))
+
+class AccessMatcher(object):
+	"""Vorkompilierte Zugriffsliste für Absender oder Empfänger.
+
+	Einträge sind Adressen (Groß-/Kleinschreibung egal) oder '@domain' für eine
+	ganze Domain. Eine Adresse mit Subadresse (user+tag@domain) passt auch auf
+	den Eintrag user@domain."""
+	def __init__(self, entries):
+		self.addresses = set()
+		self.domains = set()
+
+		for entry in entries:
+			entry = entry.strip().lower()
+			if entry.startswith('@'):
+				self.domains.add(entry[1:])
+			else:
+				self.addresses.add(entry)
+
+	def __contains__(self, address):
+		address = address.strip().lower()
+		if address in self.addresses:
+			return True
+
+		local, sep, domain = address.rpartition('@')
+		if not sep:
+			return False
+
+		if domain in self.domains:
+			return True
+
+		if '+' in local:
+			return "{0}@{1}".format(local.split('+', 1)[0], domain) in self.addresses
+
+		return False
+
+class Dispositions(object):
+	"""Sammelt die Ergebnisse bearbeiteter Mails und wendet sie gebündelt auf dem Server an:
+	ein Flag-Kommando je Ergebnisart und ein MOVE (bzw. COPY + gezieltes EXPUNGE) je Stapel."""
+	def __init__(self, server, target_folder, peek=False, batch_size=50, name=None):
+		self.server = server
+		self.name = name
+		self.target_folder = target_folder
+		self.peek = peek
+		self.batch_size = batch_size
+		self.uploaded = []
+		self.unseen = []
+		self.seen = []
+
+	def __len__(self):
+		return len(self.uploaded) + len(self.unseen) + len(self.seen)
+
+	def add(self, msgid, result):
+		MESSAGES.inc(configuration=self.name, result=result.name)
+
+		if result is PROCESSING_RESULT.UPLOADED:
+			self.uploaded.append(msgid)
+		elif result in (PROCESSING_RESULT.IGNORE, PROCESSING_RESULT.OTHER):
+			self.unseen.append(msgid)
+		elif self.peek:
+			## BODY.PEEK setzt kein \Seen, also wie beim RFC822-Abruf nachholen
+			self.seen.append(msgid)
+
+		if self.batch_size and len(self) >= self.batch_size:
+			self.apply()
+
+	def apply(self):
+		uploaded, unseen, seen = self.uploaded, self.unseen, self.seen
+		self.uploaded, self.unseen, self.seen = [], [], []
+
+		if uploaded:
+			self.server.add_flags(uploaded, [imapclient.SEEN])
+			if self.server.has_capability('MOVE'):
+				self.server.move(uploaded, self.target_folder)
+			else:
+				self.server.copy(uploaded, self.target_folder)
+				self.server.delete_messages(uploaded)
+				if self.server.has_capability('UIDPLUS'):
+					self.server.uid_expunge(uploaded)
+				else:
+					self.server.expunge()
+
+		if unseen:
+			self.server.remove_flags(unseen, [imapclient.SEEN])
+
+		if seen:
+			self.server.add_flags(seen, [imapclient.SEEN])
+
 class ImapReceiver(RestClientUser):
 	def __init__(self, configuration):
 		super(ImapReceiver, self).__init__(configuration)
 		self.logger = logging.getLogger('lexofficetools.mail[{0}]'.format(configuration.name))
 
+		self.spool_threshold = configuration["imap"].get("spool_threshold", SPOOL_THRESHOLD)
+
+		self.access_from = AccessMatcher(configuration.get("access", {}).get("from", []))
+		self.access_to = AccessMatcher(configuration.get("access", {}).get("to", []))
+
+		self.ledger = None
+		if configuration["imap"].get("dedup", True):
+			self.ledger = UploadLedger(account_key(configuration))
+
+		self.checkpoints = None
+		if configuration["imap"].get("incremental", False):
+			self.checkpoints = MailboxCheckpoints()
+
+		self.outbox = None
+		self._outbox_workers = []
+		self._outbox_recovered = []
+		if configuration["imap"].get("outbox", False):
+			self.outbox = Outbox(configuration.name)
+
+		self.images = None
+		self.upload_workers = configuration["imap"].get("upload_workers", 0)
+		if configuration["imap"].get("images", False):
+			self.images = ImageTransformer(configuration["imap"]["images"], configuration.name, self.spool_threshold)
+			## Das Verkleinern läuft in den Upload-Workern, damit es den IMAP-Thread nicht aufhält
+			self.upload_workers = max(1, self.upload_workers)
+
+		## AsyncReceiverPool hält die Signale selbst in der Event-Loop an
+		self.protect_signals = True
+
+		self._mailbox = None
+
 	def run(self):
+		server = self.connect()
+
+		while True:
+			self.process_mailbox(server)
+
+			server.idle()
+			server.idle_check(timeout=self.idle_timeout())  # Do a normal poll every 5 minutes, just in case
+			server.idle_done()
+
+	def signal_guard(self):
+		## SIGINT/SIGTERM nicht mitten in einem Durchlauf zustellen. Das wirkt nur im Thread,
+		## in dem das Signal ankommt, also im Hauptthread.
+		if self.protect_signals:
+			return suspended_signals(SIGINT, SIGTERM)
+		return contextlib.nullcontext()
+
+	def idle_timeout(self):
+		if self.outbox is not None and self.outbox.has_pending():
+			return OUTBOX_DISPOSE_INTERVAL
+		return IDLE_TIMEOUT
+
+	def connect(self):
 		config = self.config["imap"]
 
 		server = imapclient.IMAPClient(config["server"], port=config["port"], ssl=config["ssl"])
@@ -47,47 +325,297 @@ class ImapReceiver(RestClientUser):
 
 		server.debug=config.get("debug", False)
 
-		while True:
-			target_folder = "Hochgeladen {0}".format( datetime.date.today().year )
-			if not server.folder_exists(target_folder):
-				server.create_folder(target_folder)
-				server.subscribe_folder(target_folder)
-
-			select_info = server.select_folder('INBOX')
-			if select_info[b"EXISTS"]:
-				messages = server.search(['NOT', 'DELETED', 'NOT', 'SEEN'])
-				
-				with suspended_signals(SIGINT, SIGTERM):
-					response = server.fetch(messages, ['RFC822'])
-
-					for msgid, data in response.items():
-						body = data[b'RFC822']
-						target = None
-						result = PROCESSING_RESULT.ERROR
+		if self.checkpoints is not None and server.has_capability('CONDSTORE') and server.has_capability('ENABLE'):
+			## Damit SELECT HIGHESTMODSEQ mitliefert
+			server.enable('CONDSTORE')
 
-						try:
-							message = email.message_from_bytes(body)
+		if self.outbox is not None and not self._outbox_workers:
+			## Vor dem Start der Worker: Mails, deren Einreihen ein früherer Prozess nicht
+			## abgeschlossen hat, werden zurückgenommen und neu bearbeitet
+			self._outbox_recovered = self.outbox.rollback_unsealed()
+			for key in self._outbox_recovered:
+				self.logger.warning("Unvollständig eingereihte Mail %s wird erneut bearbeitet", key)
 
-							result = self.handle_mail(message)
+			for i in range(config.get("outbox_workers", 2)):
+				worker = threading.Thread(target=self._outbox_worker, name="Outbox-{0}-{1}".format(self.config.name, i))
+				worker.daemon = True
+				worker.start()
+				self._outbox_workers.append(worker)
 
-						except:
-							self.logger.exception("Fehler beim Bearbeiten der Mail {0}".format(msgid))
+		return server
 
-						finally:
-							if result is PROCESSING_RESULT.UPLOADED:
-								server.add_flags(msgid, [imapclient.SEEN])
-								server.copy(msgid, target_folder)
-								server.delete_messages(msgid)
-								server.expunge()
-							elif result in (PROCESSING_RESULT.IGNORE, PROCESSING_RESULT.OTHER):
-								server.remove_flags(msgid, [imapclient.SEEN])
+	def process_mailbox(self, server):
+		config = self.config["imap"]
 
+		target_folder = "Hochgeladen {0}".format( datetime.date.today().year )
+		if not server.folder_exists(target_folder):
+			server.create_folder(target_folder)
+			server.subscribe_folder(target_folder)
+
+		select_info = server.select_folder('INBOX')
+		self._mailbox = ('INBOX', select_info.get(b'UIDVALIDITY'))
+		if select_info[b"EXISTS"]:
+			messages = self.search_messages(server, 'INBOX', select_info)
+			if self._outbox_recovered:
+				## Diese Mails sind schon \Seen bzw. liegen hinter dem Checkpoint
+				recovered = [uid for (mailbox, uidvalidity, uid) in self._outbox_recovered if (mailbox, uidvalidity) == self._mailbox]
+				messages = sorted(set(messages) | set(recovered))
+				self._outbox_recovered = []
+
+			with self.signal_guard():
+				dispositions = Dispositions(server, target_folder,
+					peek=config.get("partial_fetch", False), batch_size=config.get("disposition_batch_size", 50),
+					name=self.config.name)
+
+				completed = []
+				try:
+					if self.outbox is not None:
+						completed = self.dispose_outbox(dispositions)
+
+					if self.upload_workers:
+						self.process_pipelined(server, messages, dispositions)
+					else:
+						self.process_sequential(server, messages, dispositions)
+				finally:
+					dispositions.apply()
+
+				if completed:
+					self.outbox.forget(completed)
+
+				self.update_checkpoint('INBOX', select_info, messages)
+
+	def search_messages(self, server, mailbox, select_info):
+		checkpoint = None
+		if self.checkpoints is not None:
+			checkpoint = self.checkpoints.get(self.config.name, mailbox)
+
+		if checkpoint is None or checkpoint.uidvalidity != select_info.get(b'UIDVALIDITY'):
+			return server.search(['NOT', 'DELETED', 'NOT', 'SEEN'])
+
+		if select_info.get(b'UIDNEXT', None) is not None and select_info[b'UIDNEXT'] <= checkpoint.last_uid+1:
+			return []
+
+		if select_info.get(b'HIGHESTMODSEQ', None) is not None and select_info[b'HIGHESTMODSEQ'] == checkpoint.highestmodseq:
+			return []
+
+		## UID n:* liefert immer mindestens die letzte Mail, auch wenn deren UID kleiner ist
+		messages = server.search(['UID', '{0}:*'.format(checkpoint.last_uid+1), 'NOT', 'DELETED'])
+		return [msgid for msgid in messages if msgid > checkpoint.last_uid]
+
+	def update_checkpoint(self, mailbox, select_info, messages):
+		if self.checkpoints is None:
+			return
+
+		last_uid = list(messages)
+		checkpoint = self.checkpoints.get(self.config.name, mailbox)
+		if checkpoint is not None and checkpoint.uidvalidity == select_info.get(b'UIDVALIDITY'):
+			last_uid.append(checkpoint.last_uid)
+		if select_info.get(b'UIDNEXT', None) is not None:
+			last_uid.append(select_info[b'UIDNEXT'] - 1)
+
+		if last_uid:
+			self.checkpoints.set(self.config.name, mailbox, select_info.get(b'UIDVALIDITY'), max(last_uid), select_info.get(b'HIGHESTMODSEQ', None))
+
+	def outbox_key(self, msgid):
+		if self.outbox is None:
+			return None
+		mailbox, uidvalidity = self._mailbox
+		return (mailbox, uidvalidity, msgid)
+
+	def dispose_outbox(self, dispositions):
+		"""Übernimmt Mails, deren Anhänge die Outbox vollständig hochgeladen hat."""
+		mailbox, uidvalidity = self._mailbox
+		completed = []
+		for message, message_uidvalidity, uid, message_id, success in self.outbox.completed(mailbox):
+			if message_uidvalidity == uidvalidity:
+				result = PROCESSING_RESULT.UPLOADED if success else PROCESSING_RESULT.ERROR
+				self.record_mail(message_id, result)
+				dispositions.add(uid, result)
+			completed.append(message)
+		return completed
+
+	def process_sequential(self, server, messages, dispositions):
+		for msgid, data in self.fetch_messages(server, messages):
+			result = PROCESSING_RESULT.ERROR
+
+			try:
+				message = self.parse_message(data)
+
+				result = self.handle_mail(message, self.outbox_key(msgid))
+
+			except:
+				self.logger.exception("Fehler beim Bearbeiten der Mail {0}".format(msgid))
+
+			finally:
+				dispositions.add(msgid, result)
+
+	def process_pipelined(self, server, messages, dispositions):
+		## Abruf, Parsen und Hochladen laufen überlappend, verbunden durch beschränkte Queues.
+		## Die IMAP-Verbindung wird nur aus diesem Thread benutzt.
+		config = self.config["imap"]
+		queue_size = config.get("queue_size", 8)
+
+		parse_queue = queue.Queue(queue_size)
+		upload_queue = queue.Queue(queue_size)
+		done_queue = queue.Queue()
+
+		workers = [ threading.Thread(target=self._parse_stage, name="Parser-{0}".format(self.config.name),
+			args=(parse_queue, upload_queue, done_queue, self.upload_workers)) ]
+		for i in range(self.upload_workers):
+			workers.append( threading.Thread(target=self._upload_stage, name="Uploader-{0}-{1}".format(self.config.name, i),
+				args=(upload_queue, done_queue)) )
+
+		for worker in workers:
+			worker.daemon = True
+			worker.start()
+
+		outstanding = 0
+		try:
+			for msgid, data in self.fetch_messages(server, messages, config.get("fetch_chunk_size", queue_size)):
+				parse_queue.put( PendingMail(msgid, data, self.outbox_key(msgid)) )
+				outstanding = outstanding + 1
+				outstanding = outstanding - self._dispose_completed(done_queue, dispositions)
+
+		finally:
+			parse_queue.put(None)
+
+			while outstanding > 0:
+				outstanding = outstanding - self._dispose_completed(done_queue, dispositions, block=True)
+
+			for worker in workers:
+				worker.join()
+
+	def _dispose_completed(self, done_queue, dispositions, block=False):
+		count = 0
+		try:
+			pending = done_queue.get(block)
+			while True:
+				result = pending.get_result()
+				self.record_mail(pending.message_id, result, pending.key)
+				dispositions.add(pending.msgid, result)
+				count = count + 1
+				pending = done_queue.get_nowait()
+		except queue.Empty:
+			pass
+		return count
+
+	def _parse_stage(self, parse_queue, upload_queue, done_queue, upload_workers):
+		while True:
+			pending = parse_queue.get()
+			if pending is None:
+				break
 
-			server.idle()
-			server.idle_check(timeout=300)  # Do a normal poll every 5 minutes, just in case
-			server.idle_done()
+			result = None
+			try:
+				message = self.parse_message(pending.data)
+				pending.data = None
+				pending.message_id = message.get('Message-ID')
 
-	def handle_mail(self, message):
+				pending.result = self.check_mail(message)
+				if pending.result is None:
+					for attachment in self.extract_attachments(message):
+						pending.add()
+						upload_queue.put( (pending, attachment) )
+
+			except:
+				self.logger.exception("Fehler beim Bearbeiten der Mail {0}".format(pending.msgid))
+				result = PROCESSING_RESULT.ERROR
+
+			if pending.done(result):
+				done_queue.put(pending)
+
+		for i in range(upload_workers):
+			upload_queue.put(None)
+
+	def _upload_stage(self, upload_queue, done_queue):
+		while True:
+			item = upload_queue.get()
+			if item is None:
+				break
+
+			pending, (name, ctype, data) = item
+			if pending.done( self.upload_attachment(name, ctype, data, pending.key) ):
+				done_queue.put(pending)
+
+	def fetch_messages(self, server, messages, chunk_size=None):
+		if chunk_size:
+			for i in range(0, len(messages), chunk_size):
+				yield from self.fetch_messages(server, messages[i:i+chunk_size])
+			return
+
+		if not self.config["imap"].get("partial_fetch", False):
+			with IMAP_FETCH_SECONDS.time(configuration=self.config.name):
+				response = server.fetch(messages, ['RFC822'])
+			yield from response.items()
+			return
+
+		## Erst nur Struktur und Header holen, dann gezielt die Teile, die handle_mail verwenden würde
+		with IMAP_FETCH_SECONDS.time(configuration=self.config.name):
+			response = server.fetch(messages, ['BODYSTRUCTURE', 'BODY.PEEK[HEADER]'])
+
+		result = collections.OrderedDict()
+		by_sections = collections.OrderedDict()
+		for msgid, data in response.items():
+			sections = tuple(acceptable_sections(data[b'BODYSTRUCTURE']))
+			result[msgid] = {b'BODY[HEADER]': data[b'BODY[HEADER]'], b'SECTIONS': list(sections)}
+			if sections:
+				by_sections.setdefault(sections, []).append(msgid)
+
+		## Ein FETCH je Gruppe von Mails mit denselben Teilen, nicht einer je Mail
+		for sections, msgids in by_sections.items():
+			items = []
+			for section in sections:
+				items.append('BODY.PEEK[{0}.MIME]'.format(section))
+				items.append('BODY.PEEK[{0}]'.format(section))
+			with IMAP_FETCH_SECONDS.time(configuration=self.config.name):
+				for msgid, data in server.fetch(msgids, items).items():
+					if msgid in result:
+						result[msgid].update(data)
+
+		yield from result.items()
+
+	def parse_message(self, data):
+		if b'RFC822' in data:
+			return email.message_from_bytes(data[b'RFC822'])
+
+		message = email.message_from_bytes(data[b'BODY[HEADER]'])
+		if message.get_content_maintype() == 'multipart':
+			parts = []
+			for section in data[b'SECTIONS']:
+				mime = data.get('BODY[{0}.MIME]'.format(section).encode('us-ascii'), b'')
+				body = data.get('BODY[{0}]'.format(section).encode('us-ascii'), b'')
+				parts.append( email.message_from_bytes(mime + body) )
+			message.set_payload(parts)
+
+		return message
+
+	def handle_mail(self, message, key=None):
+		"""Bearbeitet eine Mail. Mit key (siehe outbox_key) gehen die Anhänge in die Outbox."""
+		result = self.check_mail(message)
+		if result is not None:
+			return result
+
+		results = []
+		try:
+			for (name, ctype, data) in self.extract_attachments(message):
+				results.append( self.upload_attachment(name, ctype, data, key) )
+		except:
+			self.record_mail(message.get('Message-ID'), PROCESSING_RESULT.ERROR, key)
+			raise
+
+		result = summarize_result(results)
+		self.record_mail(message.get('Message-ID'), result, key)
+		return result
+
+	def record_mail(self, message_id, result, key=None):
+		if self.ledger is not None and result is PROCESSING_RESULT.UPLOADED:
+			self.ledger.add_message(message_id)
+
+		if key is not None and result in (PROCESSING_RESULT.QUEUED, PROCESSING_RESULT.ERROR):
+			## Ab jetzt kommen keine Anhänge mehr dazu, die Outbox darf die Mail abschließen
+			self.outbox.seal(key, message_id, failed=result is PROCESSING_RESULT.ERROR)
+
+	def check_mail(self, message):
 		if not message.is_multipart():
 			self.logger.info("Message is not multipart message")
 			return PROCESSING_RESULT.OTHER
@@ -96,9 +624,13 @@ class ImapReceiver(RestClientUser):
 			self.logger.info("Message not from allowed sender or recipient")
 			return PROCESSING_RESULT.IGNORE
 
-		upload_count = 0
-		error_count = 0
+		if self.ledger is not None and self.ledger.has_message(message.get('Message-ID')):
+			self.logger.info("Message %s was already uploaded", message.get('Message-ID'))
+			return PROCESSING_RESULT.UPLOADED
+
+		return None
 
+	def extract_attachments(self, message):
 		for part in message.walk():
 			ctype = part.get_content_type()
 			name, data = None, None
@@ -106,60 +638,154 @@ class ImapReceiver(RestClientUser):
 
 			if ctype in ACCEPTABLE_LIST + ACCEPTABLE_ZIP + [ACCEPTABLE_OCTET]:
 				name = decode_header_value( part.get_filename() )
-				data = part.get_payload(decode=True)
+				data = decode_payload(part, self.spool_threshold)
+
+				if not payload_size(data):
+					data.close()
+					data = None
 
-			if ctype == ACCEPTABLE_OCTET:
-				magic_type = magic.from_buffer(data, mime=True)
+			if data and ctype == ACCEPTABLE_OCTET:
+				magic_type = sniff_type(data.read(SNIFF_BYTES))
+				data.seek(0)
 				if magic_type in ACCEPTABLE_LIST + ACCEPTABLE_ZIP:
 					ctype = magic_type
 				else:
+					data.close()
 					data = None
 
 			if data:
 				if ctype in ACCEPTABLE_ZIP:
-					part_iter = self.handle_zip(name, ctype, data)
-				else:
-					part_iter = [ (name, ctype, data) ]
-
-				for (name, ctype, data) in part_iter:
-					self.logger.info("Have attachment %r (%s) of size %s", name, ctype, len(data))
-					self.ensure_login()
-					result = None
 					try:
-						result = self.c.upload_image(name, data, ctype)
-					except:
-						self.logger.exception("Fehler beim Hochladen des Attachments {0}".format(name))
-						error_count = error_count+1
-
-					if result:
-						self.logger.info("Attachment hochgeladen, Ergebnis: {0}".format(result))
-						upload_count = upload_count+1
-
-		if error_count > 0:
+						yield from self.handle_zip(name, ctype, data)
+					finally:
+						data.close()
+				else:
+					yield (name, ctype, data)
+
+	def upload_attachment(self, name, ctype, data, key=None):
+		"""Lädt einen Anhang hoch (oder reiht ihn mit key in die Outbox ein) und schließt
+		ihn danach. Ergebnis ist ein PROCESSING_RESULT für diesen Anhang."""
+		with data:
+			upload = data
+			if self.images is not None:
+				try:
+					name, ctype, upload = self.images.transform(name, ctype, data)
+				except:
+					self.logger.exception("Fehler beim Verkleinern des Bildes {0}".format(name))
+
+			try:
+				result = self._upload_attachment(name, ctype, upload, key)
+			finally:
+				if upload is not data:
+					upload.close()
+
+			ATTACHMENTS.inc(configuration=self.config.name, result=result.name)
+			return result
+
+	def _upload_attachment(self, name, ctype, data, key):
+		size = payload_size(data)
+		self.logger.info("Have attachment %r (%s) of size %s", name, ctype, size)
+		ATTACHMENT_BYTES.inc(size, configuration=self.config.name)
+		try:
+			if self.ledger is not None and self.ledger.has_attachment(data):
+				self.logger.info("Attachment %r was already uploaded", name)
+				return PROCESSING_RESULT.UPLOADED
+
+			if key is not None:
+				self.outbox.add(key, name, ctype, data)
+				return PROCESSING_RESULT.QUEUED
+
+			return self._upload(name, ctype, data)
+		except:
+			self.logger.exception("Fehler beim Hochladen des Attachments {0}".format(name))
 			return PROCESSING_RESULT.ERROR
 
-		if upload_count > 0:
+	def _upload(self, name, ctype, data):
+		self.ensure_login()
+		result = self.c.upload_image(name, data, ctype)
+
+		if result:
+			self.logger.info("Attachment hochgeladen, Ergebnis: {0}".format(result))
+			if self.ledger is not None:
+				self.ledger.add_attachment(data, name)
 			return PROCESSING_RESULT.UPLOADED
 
 		return PROCESSING_RESULT.PROCESSED
 
-	def handle_zip(self, name, ctype, data, recursion=0):
+	def _outbox_worker(self):
+		max_attempts = self.config["imap"].get("outbox_max_attempts", None)
+
+		while True:
+			try:
+				entry = self.outbox.claim(OUTBOX_LEASE)
+				if entry is None:
+					time.sleep(OUTBOX_POLL_INTERVAL)
+					continue
+
+				try:
+					with open(entry.path, "rb") as fp:
+						self._upload(entry.name, entry.content_type, fp)
+
+				except Exception as e:
+					if is_permanent_error(e) or (max_attempts is not None and entry.attempts+1 >= max_attempts):
+						self.logger.exception("Hochladen des Attachments {0} endgültig fehlgeschlagen".format(entry.name))
+						self.outbox.finish(entry, failed=True, error=str(e))
+					else:
+						delay = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2**entry.attempts) * random.uniform(0.5, 1.0)
+						self.logger.warning("Hochladen des Attachments %s fehlgeschlagen (%s), neuer Versuch in %d Sekunden", entry.name, e, delay)
+						self.outbox.retry(entry, delay, error=str(e))
+
+				else:
+					self.outbox.finish(entry)
+
+			except:
+				self.logger.exception("Fehler in der Outbox")
+				time.sleep(OUTBOX_POLL_INTERVAL)
+
+	def handle_zip(self, name, ctype, data, recursion=0, budget=None):
+		if budget is None:
+			limits = dict(ZIP_LIMITS)
+			limits.update(self.config["imap"].get("zip_limits", {}))
+			budget = ZipBudget(**limits)
+
+		if isinstance(data, bytes):
+			data = io.BytesIO(data)
+
 		if recursion <= ZIP_RECURSION_LIMIT:
-			zio = io.BytesIO(data)
-			with zipfile.ZipFile(zio) as zfile:
+			with zipfile.ZipFile(data) as zfile:
 				for finfo in zfile.infolist():
-					fdata = zfile.read(finfo)
-
-					fctype = magic.from_buffer(fdata, mime=True)
+					if finfo.is_dir():
+						continue
 
 					new_name = "{0}::{1}".format(name, finfo.filename)
+					budget.check_member(new_name, finfo)
+
+					with zfile.open(finfo) as fp:
+						## Typ nur anhand des Anfangs bestimmen, unpassende Dateien werden nicht weiter entpackt
+						head = fp.read(SNIFF_BYTES)
+						fctype = sniff_type(head)
+
+						if fctype not in ACCEPTABLE_LIST + ACCEPTABLE_ZIP:
+							continue
+
+						fdata = spooled_file(self.spool_threshold)
+						fdata.write(head)
+						copy_limited(fp, fdata, budget.max_member_size + 1 - len(head))
+						fdata.seek(0)
+
+					try:
+						budget.check_data(new_name, finfo, payload_size(fdata))
+					except:
+						fdata.close()
+						raise
 
 					if fctype in ACCEPTABLE_LIST:
 						yield (new_name, fctype, fdata)
 					elif fctype in ACCEPTABLE_ZIP:
-						yield from self.handle_zip(new_name, fctype, fdata, recursion+1)
-
-
+						try:
+							yield from self.handle_zip(new_name, fctype, fdata, recursion+1, budget)
+						finally:
+							fdata.close()
 
 
 	def check_access(self, message):
@@ -167,13 +793,11 @@ class ImapReceiver(RestClientUser):
 		recipients = message.get_all('to', []) + message.get_all('cc', [])
 
 		for name, sender in email.utils.getaddresses(senders):
-			for allowed_sender in self.config.get("access", {}).get("from", []):
-				if sender.lower() == allowed_sender.lower():
-					return True
+			if sender in self.access_from:
+				return True
 
 		for name, recipient in email.utils.getaddresses(recipients):
-			for allowed_recipient in self.config.get("access", {}).get("to", []):
-				if recipient.lower() == allowed_recipient.lower():
-					return True
+			if recipient in self.access_to:
+				return True
 
 		return False
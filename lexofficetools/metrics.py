@@ -0,0 +1,236 @@
+import os, os.path
+import json
+import time
+import glob
+import threading
+import http.server
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+FLUSH_INTERVAL = 15
+
+class Metric(object):
+	type_ = None
+
+	def __init__(self, registry, name, help, labelnames=()):
+		self.registry = registry
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+
+	def _key(self, labels):
+		return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+class Counter(Metric):
+	type_ = 'counter'
+
+	def inc(self, amount=1, **labels):
+		self.registry.touch()
+		with self.registry.lock:
+			values = self.registry.values.setdefault(self.name, {})
+			key = self._key(labels)
+			values[key] = values.get(key, 0) + amount
+
+class Histogram(Metric):
+	type_ = 'histogram'
+
+	def __init__(self, registry, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		super(Histogram, self).__init__(registry, name, help, labelnames)
+		self.buckets = tuple(buckets)
+
+	def observe(self, value, **labels):
+		self.registry.touch()
+		with self.registry.lock:
+			values = self.registry.values.setdefault(self.name, {})
+			key = self._key(labels)
+			if key not in values:
+				values[key] = [0] * len(self.buckets) + [0, 0.0]  # Buckets, Anzahl, Summe
+			entry = values[key]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					entry[i] = entry[i] + 1
+			entry[-2] = entry[-2] + 1
+			entry[-1] = entry[-1] + value
+
+	@contextmanager
+	def time(self, **labels):
+		"""Misst die Dauer des Blocks. Labels können im Block noch ergänzt werden."""
+		start = time.monotonic()
+		try:
+			yield labels
+		finally:
+			self.observe(time.monotonic() - start, **labels)
+
+class Registry(object):
+	"""Zähler und Histogramme eines Prozesses. Mit enable() schreibt jeder Prozess seine
+	Werte regelmäßig als JSON in ein Verzeichnis, das sich nur die Prozesse eines Aufrufs
+	teilen und aus dem der MetricsExporter im Hauptprozess sie zusammenfasst."""
+	def __init__(self):
+		self.metrics = {}
+		self.values = {}
+		self.lock = threading.Lock()
+		self.directory = None
+		self._pid = os.getpid()
+		self._flusher_pid = None
+
+	def counter(self, name, help, labelnames=()):
+		return self.metrics.setdefault(name, Counter(self, name, help, labelnames))
+
+	def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+		return self.metrics.setdefault(name, Histogram(self, name, help, labelnames, buckets))
+
+	def enable(self, directory):
+		"""Ab jetzt schreibt jeder Prozess seine Werte nach directory."""
+		os.makedirs(directory, exist_ok=True)
+		self.directory = directory
+
+	def disable(self):
+		"""Beendet das Schreiben nach directory, z.B. bevor es entfernt wird."""
+		self.directory = None
+
+	def touch(self):
+		## Nach einem fork() beginnt das Kind mit leeren Werten und eigenem Schreib-Thread
+		if self._pid != os.getpid() or (self.directory is not None and self._flusher_pid != os.getpid()):
+			with self.lock:
+				if self._pid != os.getpid():
+					self.values = {}
+					self._pid = os.getpid()
+				if self.directory is not None and self._flusher_pid != os.getpid():
+					self._flusher_pid = os.getpid()
+					flusher = threading.Thread(target=self._flush_loop, name="Metrics-Flush")
+					flusher.daemon = True
+					flusher.start()
+
+	def snapshot(self):
+		with self.lock:
+			return {name: [[list(key), value] for key, value in values.items()] for name, values in self.values.items()}
+
+	def flush(self):
+		if self.directory is None:
+			return
+		path = os.path.join(self.directory, "{0}.json".format(os.getpid()))
+		with open(path + ".tmp", "w") as fp:
+			json.dump(self.snapshot(), fp)
+		os.replace(path + ".tmp", path)
+
+	def _flush_loop(self):
+		pid = os.getpid()
+		while self._flusher_pid == pid:
+			time.sleep(FLUSH_INTERVAL)
+			try:
+				self.flush()
+			except OSError:
+				pass
+
+REGISTRY = Registry()
+
+class MetricsExporter(object):
+	"""Fasst die Werte aller Prozesse zusammen und stellt sie bereit."""
+	def __init__(self, registry=REGISTRY):
+		self.registry = registry
+
+	def collect(self):
+		merged = {}
+		snapshots = [self.registry.snapshot()]
+		own = os.path.join(self.registry.directory or "", "{0}.json".format(os.getpid()))
+
+		if self.registry.directory is not None:
+			for path in glob.glob(os.path.join(self.registry.directory, "*.json")):
+				if path == own:
+					continue
+				try:
+					with open(path) as fp:
+						snapshots.append(json.load(fp))
+				except (OSError, ValueError):
+					pass
+
+		for snapshot in snapshots:
+			for name, entries in snapshot.items():
+				values = merged.setdefault(name, {})
+				for key, value in entries:
+					key = tuple(key)
+					if isinstance(value, list):
+						old = values.get(key, [0] * len(value))
+						values[key] = [a + b for a, b in zip(old, value)]
+					else:
+						values[key] = values.get(key, 0) + value
+
+		return merged
+
+	def render(self):
+		merged = self.collect()
+		lines = []
+
+		for name, metric in sorted(self.registry.metrics.items()):
+			lines.append("# HELP {0} {1}".format(name, metric.help))
+			lines.append("# TYPE {0} {1}".format(name, metric.type_))
+
+			for key, value in sorted(merged.get(name, {}).items()):
+				labels = list(zip(metric.labelnames, key))
+				if metric.type_ == 'counter':
+					lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+				else:
+					for bound, count in zip(metric.buckets, value):
+						lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels + [('le', repr(float(bound)))]), count))
+					lines.append("{0}_bucket{1} {2}".format(name, format_labels(labels + [('le', '+Inf')]), value[-2]))
+					lines.append("{0}_count{1} {2}".format(name, format_labels(labels), value[-2]))
+					lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), value[-1]))
+
+		return "\n".join(lines) + "\n"
+
+	def write_textfile(self, path):
+		with open(path + ".tmp", "w") as fp:
+			fp.write(self.render())
+		os.replace(path + ".tmp", path)
+
+	def start_textfile_writer(self, path, interval=FLUSH_INTERVAL):
+		def loop():
+			while True:
+				self.write_textfile(path)
+				time.sleep(interval)
+		writer = threading.Thread(target=loop, name="Metrics-Textfile")
+		writer.daemon = True
+		writer.start()
+
+	def start_http_server(self, port, address='127.0.0.1'):
+		exporter = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] not in ('/', '/metrics'):
+					self.send_error(404)
+					return
+				body = exporter.render().encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		server = http.server.HTTPServer((address, port), Handler)
+		thread = threading.Thread(target=server.serve_forever, name="Metrics-HTTP")
+		thread.daemon = True
+		thread.start()
+		return server
+
+def format_labels(labels):
+	if not labels:
+		return ""
+	return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + "}"
+
+
+IMAP_FETCH_SECONDS = REGISTRY.histogram('lexofficetools_imap_fetch_seconds', 'Dauer von IMAP-FETCH-Kommandos', ['configuration'])
+MESSAGES = REGISTRY.counter('lexofficetools_messages_total', 'Bearbeitete Mails nach Ergebnis', ['configuration', 'result'])
+ATTACHMENTS = REGISTRY.counter('lexofficetools_attachments_total', 'Bearbeitete Anhänge nach Ergebnis', ['configuration', 'result'])
+ATTACHMENT_BYTES = REGISTRY.counter('lexofficetools_attachment_bytes_total', 'Größe der bearbeiteten Anhänge', ['configuration'])
+SNIFF_SECONDS = REGISTRY.histogram('lexofficetools_sniff_seconds', 'Dauer der Dateityp-Erkennung', ['method'], buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5))
+IMAGE_SECONDS = REGISTRY.histogram('lexofficetools_image_transform_seconds', 'Dauer der Bildverkleinerung nach Ergebnis', ['configuration', 'result'])
+LEXOFFICE_SECONDS = REGISTRY.histogram('lexofficetools_lexoffice_request_seconds', 'Dauer von lexoffice-Aufrufen', ['endpoint', 'status'])
+LEXOFFICE_RETRIES = REGISTRY.counter('lexofficetools_lexoffice_retries_total', 'Wiederholte lexoffice-Aufrufe nach Grund', ['endpoint', 'reason'])
+LEXOFFICE_THROTTLE_SECONDS = REGISTRY.counter('lexofficetools_lexoffice_throttle_seconds_total', 'Wartezeit durch das Rate-Limit für lexoffice', ['instance'])
+LEXOFFICE_LOGINS = REGISTRY.counter('lexofficetools_lexoffice_logins_total', 'Anmeldungen bei lexoffice', ['configuration'])
+SCRAPER_SECONDS = REGISTRY.histogram('lexofficetools_scraper_request_seconds', 'Dauer von Seitenabrufen der Kreditkarten-Scraper', ['method', 'status'])
@@ -0,0 +1,58 @@
+import io
+import binascii
+import tempfile
+
+## Ab dieser Größe werden Anhänge in temporäre Dateien ausgelagert (imap.spool_threshold)
+SPOOL_THRESHOLD = 4*1024*1024
+
+COPY_CHUNK = 64*1024
+BASE64_CHUNK = 76*1024
+
+def spooled_file(threshold=SPOOL_THRESHOLD):
+	return tempfile.SpooledTemporaryFile(max_size=threshold)
+
+def payload_size(fp):
+	position = fp.tell()
+	fp.seek(0, io.SEEK_END)
+	size = fp.tell()
+	fp.seek(position)
+	return size
+
+def copy_limited(src, dst, limit):
+	"""Kopiert höchstens limit Bytes von src nach dst, gibt die Anzahl zurück."""
+	copied = 0
+	while copied < limit:
+		chunk = src.read(min(COPY_CHUNK, limit - copied))
+		if not chunk:
+			break
+		dst.write(chunk)
+		copied = copied + len(chunk)
+	return copied
+
+def decode_payload(part, threshold=SPOOL_THRESHOLD):
+	"""Dekodiert den Inhalt eines MIME-Teils in eine temporäre Datei. Base64 wird
+	stückweise dekodiert, sodass keine zweite vollständige Kopie im Speicher entsteht."""
+	fp = spooled_file(threshold)
+	payload = part.get_payload()
+
+	try:
+		if part.get('content-transfer-encoding', '').strip().lower() == 'base64' and isinstance(payload, str):
+			rest = ''
+			for i in range(0, len(payload), BASE64_CHUNK):
+				chunk = rest + "".join(payload[i:i+BASE64_CHUNK].split())
+				usable = len(chunk) - len(chunk) % 4
+				fp.write( binascii.a2b_base64(chunk[:usable]) )
+				rest = chunk[usable:]
+			if rest:
+				raise binascii.Error("Incorrect padding")
+		else:
+			fp.write( part.get_payload(decode=True) or b'' )
+
+	except binascii.Error:
+		## Kaputtes Base64: die nachsichtigere Dekodierung aus dem email-Modul verwenden
+		fp.seek(0)
+		fp.truncate()
+		fp.write( part.get_payload(decode=True) or b'' )
+
+	fp.seek(0)
+	return fp
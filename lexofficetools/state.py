@@ -0,0 +1,514 @@
+import os, os.path
+import sqlite3
+import threading
+import hashlib
+import time
+import collections
+import json
+import datetime
+import tempfile
+import shutil
+from contextlib import contextmanager
+
+from .utils import STATE_DIRECTORY, STATE_DATABASE, OUTBOX_DIRECTORY
+
+_create_lock = threading.Lock()
+
+class StateStore(object):
+	"""Lokaler Zustand in einer SQLite-Datenbank, die sich alle Prozesse und Threads teilen.
+
+	Verbindungen werden pro Thread (und nach einem fork() neu) geöffnet, das Objekt
+	kann also vor dem Start der Worker-Prozesse angelegt werden."""
+	SCHEMA = []
+
+	## Dateirechte der Datenbank (und damit der -wal/-shm-Dateien), die neu angelegt wird
+	MODE = 0o600
+
+	def __init__(self, path=None):
+		self.path = path or os.path.join(STATE_DIRECTORY, STATE_DATABASE)
+		self._local = threading.local()
+
+	@property
+	def db(self):
+		if getattr(self._local, 'pid', None) != os.getpid():
+			os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+			with _create_lock:
+				## Nur neu anlegen: das Schließen eines weiteren Deskriptors auf eine schon
+				## geöffnete Datenbank hebt alle POSIX-Sperren des Prozesses darauf auf
+				try:
+					os.close(os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, self.MODE))
+				except FileExistsError:
+					pass
+			db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+			db.execute("PRAGMA journal_mode=WAL")
+			for statement in self.SCHEMA:
+				db.execute(statement)
+			self._local.db = db
+			self._local.pid = os.getpid()
+		return self._local.db
+
+	@contextmanager
+	def transaction(self):
+		db = self.db
+		db.execute("BEGIN IMMEDIATE")
+		try:
+			yield db
+		except:
+			db.execute("ROLLBACK")
+			raise
+		else:
+			db.execute("COMMIT")
+
+
+class UploadLedger(StateStore):
+	"""Merkt sich pro lexoffice-Konto, welche Anhänge (per SHA-256) und welche Mails
+	(per Message-ID) schon vollständig hochgeladen wurden.
+
+	Zwei Worker, die zeitgleich denselben Anhang hochladen, werden nicht verhindert;
+	abgedeckt sind Wiederholungen nach Fehlern und Mails, die über mehrere
+	Konfigurationen eintreffen."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS uploaded_attachment (account TEXT NOT NULL, sha256 TEXT NOT NULL, name TEXT, uploaded_at REAL, PRIMARY KEY (account, sha256))",
+		"CREATE TABLE IF NOT EXISTS uploaded_message (account TEXT NOT NULL, message_id TEXT NOT NULL, uploaded_at REAL, PRIMARY KEY (account, message_id))",
+	]
+
+	def __init__(self, account, path=None):
+		super(UploadLedger, self).__init__(path)
+		self.account = account
+
+	@staticmethod
+	def digest(data):
+		if isinstance(data, bytes):
+			return hashlib.sha256(data).hexdigest()
+
+		h = hashlib.sha256()
+		position = data.tell()
+		data.seek(0)
+		for chunk in iter(lambda: data.read(64*1024), b''):
+			h.update(chunk)
+		data.seek(position)
+		return h.hexdigest()
+
+	def has_attachment(self, data):
+		row = self.db.execute("SELECT 1 FROM uploaded_attachment WHERE account=? AND sha256=?",
+			(self.account, self.digest(data))).fetchone()
+		return row is not None
+
+	def add_attachment(self, data, name=None):
+		self.db.execute("INSERT OR IGNORE INTO uploaded_attachment (account, sha256, name, uploaded_at) VALUES (?, ?, ?, ?)",
+			(self.account, self.digest(data), name, time.time()))
+
+	def has_message(self, message_id):
+		if not message_id:
+			return False
+		row = self.db.execute("SELECT 1 FROM uploaded_message WHERE account=? AND message_id=?",
+			(self.account, message_id.strip())).fetchone()
+		return row is not None
+
+	def add_message(self, message_id):
+		if message_id:
+			self.db.execute("INSERT OR IGNORE INTO uploaded_message (account, message_id, uploaded_at) VALUES (?, ?, ?)",
+				(self.account, message_id.strip(), time.time()))
+
+
+Checkpoint = collections.namedtuple('Checkpoint', ['uidvalidity', 'last_uid', 'highestmodseq'])
+
+class MailboxCheckpoints(StateStore):
+	"""Bis zu welcher UID ein Postfach je Konfiguration schon bearbeitet wurde."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS mailbox_checkpoint (configuration TEXT NOT NULL, mailbox TEXT NOT NULL, uidvalidity INTEGER, last_uid INTEGER, highestmodseq INTEGER, PRIMARY KEY (configuration, mailbox))",
+	]
+
+	def get(self, configuration, mailbox):
+		row = self.db.execute("SELECT uidvalidity, last_uid, highestmodseq FROM mailbox_checkpoint WHERE configuration=? AND mailbox=?",
+			(configuration, mailbox)).fetchone()
+		if row is None:
+			return None
+		return Checkpoint._make(row)
+
+	def set(self, configuration, mailbox, uidvalidity, last_uid, highestmodseq=None):
+		self.db.execute("INSERT OR REPLACE INTO mailbox_checkpoint (configuration, mailbox, uidvalidity, last_uid, highestmodseq) VALUES (?, ?, ?, ?, ?)",
+			(configuration, mailbox, uidvalidity, last_uid, highestmodseq))
+
+
+class SessionCache(StateStore):
+	"""Cookies der lexoffice-Sitzung je Konfiguration, damit kurze Läufe und neu
+	gestartete Worker ohne erneute Anmeldung auskommen. Die Cookies stehen im Klartext
+	in der Datenbank, die deshalb nur für den Eigentümer lesbar gemacht wird."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS lexoffice_session (configuration TEXT NOT NULL PRIMARY KEY, account TEXT NOT NULL, cookies TEXT NOT NULL, saved_at REAL)",
+	]
+
+	@property
+	def db(self):
+		db = super(SessionCache, self).db
+		if not getattr(self._local, 'private', False):
+			## Auch eine früher mit anderen Rechten angelegte Datenbank
+			for suffix in ("", "-wal", "-shm"):
+				if os.path.exists(self.path + suffix):
+					os.chmod(self.path + suffix, self.MODE)
+			self._local.private = True
+		return db
+
+	def load(self, configuration, account):
+		row = self.db.execute("SELECT cookies FROM lexoffice_session WHERE configuration=? AND account=?",
+			(configuration, account)).fetchone()
+		if row is None:
+			return None
+		return json.loads(row[0])
+
+	def save(self, configuration, account, cookies):
+		self.db.execute("INSERT OR REPLACE INTO lexoffice_session (configuration, account, cookies, saved_at) VALUES (?, ?, ?, ?)",
+			(configuration, account, json.dumps(cookies), time.time()))
+
+	def clear(self, configuration):
+		self.db.execute("DELETE FROM lexoffice_session WHERE configuration=?", (configuration, ))
+
+
+class RateLimiter(StateStore):
+	"""Token-Bucket, den sich alle Prozesse und Threads über die Zustandsdatenbank teilen.
+
+	Jeder Aufruf nimmt sofort ein Token, notfalls auf Vorschuss, und wartet dann,
+	bis es gedeckt ist. Damit kommen Wartende ungefähr in Reihenfolge dran."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS rate_limit (bucket TEXT NOT NULL PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
+	]
+
+	def __init__(self, bucket, rate, burst=None, path=None):
+		super(RateLimiter, self).__init__(path)
+		self.bucket = bucket
+		self.rate = float(rate)
+		self.burst = float(burst or max(rate, 1))
+
+	def reserve(self):
+		"""Nimmt ein Token und liefert die Wartezeit in Sekunden, bis es gedeckt ist."""
+		with self.transaction() as db:
+			now = time.time()
+			row = db.execute("SELECT tokens, updated FROM rate_limit WHERE bucket=?", (self.bucket, )).fetchone()
+			if row is None:
+				tokens = self.burst
+			else:
+				tokens = min(self.burst, row[0] + max(0, now - row[1]) * self.rate)
+			tokens = tokens - 1
+			db.execute("INSERT OR REPLACE INTO rate_limit (bucket, tokens, updated) VALUES (?, ?, ?)", (self.bucket, tokens, now))
+		return max(0.0, -tokens / self.rate)
+
+	def acquire(self):
+		delay = self.reserve()
+		if delay:
+			time.sleep(delay)
+		return delay
+
+
+## Höchstens so viele Schlüssel je Abfrage in TransactionMirror.counts(), SQLite erlaubt nur begrenzt viele Parameter
+COUNT_BATCH_SIZE = 500
+
+class TransactionMirror(StateStore):
+	"""Lokale Kopie der lexoffice-Umsätze je Finanzkonto, mit vorberechnetem
+	Vergleichsschlüssel (match_key) für den Abgleich mit den Kreditkartenumsätzen.
+
+	key(item) liefert den Vergleichsschlüssel, date(item) das Umsatzdatum als
+	datetime.date oder None, wenn es unbekannt ist."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS financial_transaction (financial_account_id TEXT NOT NULL, transaction_id TEXT NOT NULL, match_key TEXT NOT NULL, transaction_date TEXT, data TEXT NOT NULL, fetched_at REAL, PRIMARY KEY (financial_account_id, transaction_id))",
+		"CREATE INDEX IF NOT EXISTS financial_transaction_match ON financial_transaction (financial_account_id, match_key)",
+		"CREATE INDEX IF NOT EXISTS financial_transaction_date ON financial_transaction (financial_account_id, transaction_date)",
+		"CREATE TABLE IF NOT EXISTS financial_transaction_refresh (financial_account_id TEXT NOT NULL PRIMARY KEY, full_refresh REAL)",
+		## Ab welchem Datum importierte Umsätze hinzugekommen sind (stale) bzw. nach Abschluss hinzukommen (import)
+		"CREATE TABLE IF NOT EXISTS financial_transaction_stale (financial_account_id TEXT NOT NULL PRIMARY KEY, since TEXT NOT NULL)",
+		"CREATE TABLE IF NOT EXISTS financial_transaction_import (import_id TEXT NOT NULL PRIMARY KEY, financial_account_id TEXT NOT NULL, since TEXT)",
+	]
+
+	@staticmethod
+	def transaction_id(item, occurrence=0):
+		## Ohne ID von lexoffice zählt der Inhalt, gleiche Umsätze werden in Abrufreihenfolge durchnummeriert
+		if item.get('financialTransactionId'):
+			return item['financialTransactionId']
+		return "content:{0}#{1}".format(hashlib.sha256(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest(), occurrence)
+
+	@staticmethod
+	def encode_key(key):
+		return json.dumps(list(key), ensure_ascii=False)
+
+	def _rows(self, financial_account_id, transactions, key, date, now):
+		occurrences = collections.Counter()
+		for item in transactions:
+			first = self.transaction_id(item)
+			transaction_id = self.transaction_id(item, occurrences[first])
+			occurrences[first] += 1
+			item_date = date(item)
+			yield (financial_account_id, transaction_id, self.encode_key(key(item)),
+				item_date.isoformat() if item_date is not None else None, json.dumps(item), now)
+
+	def _store(self, db, rows):
+		db.executemany("INSERT OR REPLACE INTO financial_transaction (financial_account_id, transaction_id, match_key, transaction_date, data, fetched_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+	def last_full_refresh(self, financial_account_id):
+		row = self.db.execute("SELECT full_refresh FROM financial_transaction_refresh WHERE financial_account_id=?",
+			(financial_account_id, )).fetchone()
+		return row[0] if row is not None else None
+
+	def update(self, financial_account_id, transactions, key, date, overlap):
+		"""Übernimmt Umsätze (neueste zuerst), bis overlap bereits bekannte in Folge kamen.
+		Liefert die Anzahl neuer Umsätze."""
+		now = time.time()
+		rows, added, known = [], 0, 0
+
+		for row in self._rows(financial_account_id, transactions, key, date, now):
+			rows.append(row)
+
+			if self.db.execute("SELECT 1 FROM financial_transaction WHERE financial_account_id=? AND transaction_id=?", row[:2]).fetchone():
+				known = known + 1
+				if known >= overlap:
+					break
+			else:
+				known = 0
+				added = added + 1
+
+		with self.transaction() as db:
+			self._store(db, rows)
+		return added
+
+	def replace(self, financial_account_id, transactions, key, date):
+		"""Ersetzt alle Umsätze eines Kontos, z.B. um in lexoffice gelöschte zu entfernen."""
+		now = time.time()
+		rows = list(self._rows(financial_account_id, transactions, key, date, now))
+
+		with self.transaction() as db:
+			db.execute("DELETE FROM financial_transaction WHERE financial_account_id=?", (financial_account_id, ))
+			self._store(db, rows)
+			db.execute("INSERT OR REPLACE INTO financial_transaction_refresh (financial_account_id, full_refresh) VALUES (?, ?)",
+				(financial_account_id, now))
+			db.execute("DELETE FROM financial_transaction_stale WHERE financial_account_id=?", (financial_account_id, ))
+		return len(rows)
+
+	def replace_window(self, financial_account_id, transactions, key, date, since):
+		"""Ersetzt die Umsätze ab since (Datum ab since oder unbekannt) durch transactions.
+		Danach ist das Konto nicht mehr als veraltet markiert. Liefert die Anzahl der Umsätze im Fenster."""
+		now = time.time()
+		rows = [row for row in self._rows(financial_account_id, transactions, key, date, now) if row[3] is None or row[3] >= since.isoformat()]
+
+		with self.transaction() as db:
+			## Getrennt, damit beide den Index auf transaction_date nutzen
+			db.execute("DELETE FROM financial_transaction WHERE financial_account_id=? AND transaction_date>=?", (financial_account_id, since.isoformat()))
+			db.execute("DELETE FROM financial_transaction WHERE financial_account_id=? AND transaction_date IS NULL", (financial_account_id, ))
+			self._store(db, rows)
+			db.execute("DELETE FROM financial_transaction_stale WHERE financial_account_id=?", (financial_account_id, ))
+		return len(rows)
+
+	def invalidate(self, financial_account_id):
+		"""Erzwingt beim nächsten Abgleich ein komplettes Neuladen."""
+		self.db.execute("DELETE FROM financial_transaction_refresh WHERE financial_account_id=?", (financial_account_id, ))
+
+	def stale_since(self, financial_account_id):
+		"""Ab diesem Datum (datetime.date) ist die Kopie durch abgeschlossene Importe veraltet, sonst None."""
+		row = self.db.execute("SELECT since FROM financial_transaction_stale WHERE financial_account_id=?", (financial_account_id, )).fetchone()
+		return datetime.date.fromisoformat(row[0]) if row is not None else None
+
+	def mark_stale(self, financial_account_id, since):
+		"""Merkt vor, dass ab since Umsätze hinzugekommen sind, ohne since lädt der nächste Abgleich alles."""
+		if since is None:
+			self.invalidate(financial_account_id)
+			return
+
+		with self.transaction() as db:
+			row = db.execute("SELECT since FROM financial_transaction_stale WHERE financial_account_id=?", (financial_account_id, )).fetchone()
+			if row is not None:
+				since = min(since, datetime.date.fromisoformat(row[0]))
+			db.execute("INSERT OR REPLACE INTO financial_transaction_stale (financial_account_id, since) VALUES (?, ?)",
+				(financial_account_id, since.isoformat()))
+
+	def expect_import(self, import_id, financial_account_id, since):
+		"""Merkt sich den Datumsbereich eines laufenden Imports für import_finished()."""
+		self.db.execute("INSERT OR REPLACE INTO financial_transaction_import (import_id, financial_account_id, since) VALUES (?, ?, ?)",
+			(import_id, financial_account_id, since.isoformat() if since is not None else None))
+
+	def import_finished(self, import_id, done):
+		"""Nur ein erfolgreicher Import (done) macht die Kopie ab seinem ältesten Umsatz veraltet."""
+		row = self.db.execute("SELECT financial_account_id, since FROM financial_transaction_import WHERE import_id=?", (import_id, )).fetchone()
+		if row is None:
+			return
+		if done:
+			self.mark_stale(row[0], datetime.date.fromisoformat(row[1]) if row[1] is not None else None)
+		self.db.execute("DELETE FROM financial_transaction_import WHERE import_id=?", (import_id, ))
+
+	def counts(self, financial_account_id, keys):
+		"""Anzahl der Umsätze je match_key (kodiert wie encode_key), nur für die angegebenen keys."""
+		keys = sorted(set(keys))
+		result = collections.Counter()
+		for start in range(0, len(keys), COUNT_BATCH_SIZE):
+			batch = keys[start:start+COUNT_BATCH_SIZE]
+			result.update(dict(self.db.execute("SELECT match_key, COUNT(*) FROM financial_transaction WHERE financial_account_id=? AND match_key IN ({0}) GROUP BY match_key".format(
+				",".join("?" * len(batch))), [financial_account_id] + batch).fetchall()))
+		return result
+
+
+class ImportProfiles(StateStore):
+	"""Fingerabdruck der zuletzt per PUT gesetzten Import-Einstellungen je Finanzkonto."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS import_profile (financial_account_id TEXT NOT NULL PRIMARY KEY, fingerprint TEXT NOT NULL, updated_at REAL)",
+	]
+
+	@staticmethod
+	def fingerprint(settings):
+		return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+	def is_current(self, financial_account_id, settings):
+		row = self.db.execute("SELECT fingerprint FROM import_profile WHERE financial_account_id=?", (financial_account_id, )).fetchone()
+		return row is not None and row[0] == self.fingerprint(settings)
+
+	def set(self, financial_account_id, settings):
+		self.db.execute("INSERT OR REPLACE INTO import_profile (financial_account_id, fingerprint, updated_at) VALUES (?, ?, ?)",
+			(financial_account_id, self.fingerprint(settings), time.time()))
+
+	def clear(self, financial_account_id):
+		self.db.execute("DELETE FROM import_profile WHERE financial_account_id=?", (financial_account_id, ))
+
+
+ImportJob = collections.namedtuple('ImportJob', ['import_id', 'financial_account_id', 'description', 'submitted_at'])
+
+class ImportJournal(StateStore):
+	"""Angestoßene Transaktions-Importe, deren Ende noch nicht beobachtet wurde.
+	Was bei einem Lauf nicht fertig wird, verfolgt der nächste weiter."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS pending_import (import_id TEXT NOT NULL PRIMARY KEY, configuration TEXT NOT NULL, financial_account_id TEXT, description TEXT, submitted_at REAL)",
+	]
+
+	def __init__(self, configuration, path=None):
+		super(ImportJournal, self).__init__(path)
+		self.configuration = configuration
+
+	def add(self, import_id, financial_account_id, description):
+		job = ImportJob(import_id, financial_account_id, description, time.time())
+		self.db.execute("INSERT OR REPLACE INTO pending_import (import_id, configuration, financial_account_id, description, submitted_at) VALUES (?, ?, ?, ?, ?)",
+			(job.import_id, self.configuration, job.financial_account_id, job.description, job.submitted_at))
+		return job
+
+	def pending(self, financial_account_id=None):
+		if financial_account_id is None:
+			rows = self.db.execute("SELECT import_id, financial_account_id, description, submitted_at FROM pending_import WHERE configuration=? ORDER BY submitted_at",
+				(self.configuration, )).fetchall()
+		else:
+			rows = self.db.execute("SELECT import_id, financial_account_id, description, submitted_at FROM pending_import WHERE configuration=? AND financial_account_id=? ORDER BY submitted_at",
+				(self.configuration, financial_account_id)).fetchall()
+		return [ImportJob._make(row) for row in rows]
+
+	def remove(self, import_id):
+		self.db.execute("DELETE FROM pending_import WHERE import_id=?", (import_id, ))
+
+
+OutboxEntry = collections.namedtuple('OutboxEntry', ['id', 'name', 'content_type', 'path', 'attempts'])
+
+class Outbox(StateStore):
+	"""Warteschlange für Anhänge, die noch zu lexoffice hochgeladen werden müssen.
+
+	Jeder Anhang liegt als Datei im Outbox-Verzeichnis, bis er hochgeladen ist. Eine Mail
+	gilt als erledigt, wenn sie versiegelt ist (alle Anhänge eingereiht) und keiner
+	ihrer Anhänge mehr aussteht."""
+	SCHEMA = [
+		"CREATE TABLE IF NOT EXISTS outbox_message (id INTEGER PRIMARY KEY, configuration TEXT NOT NULL, mailbox TEXT NOT NULL, uidvalidity INTEGER, uid INTEGER, message_id TEXT, sealed INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, UNIQUE (configuration, mailbox, uidvalidity, uid))",
+		"CREATE TABLE IF NOT EXISTS outbox_attachment (id INTEGER PRIMARY KEY, message INTEGER NOT NULL REFERENCES outbox_message(id), name TEXT, content_type TEXT, path TEXT, state TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, next_attempt REAL, claimed_until REAL, last_error TEXT)",
+		"CREATE INDEX IF NOT EXISTS outbox_attachment_due ON outbox_attachment (state, next_attempt)",
+	]
+
+	def __init__(self, configuration, path=None, directory=None):
+		super(Outbox, self).__init__(path)
+		self.configuration = configuration
+		self.directory = directory or os.path.join(STATE_DIRECTORY, OUTBOX_DIRECTORY)
+
+	def _message(self, db, key, message_id=None):
+		mailbox, uidvalidity, uid = key
+		db.execute("INSERT OR IGNORE INTO outbox_message (configuration, mailbox, uidvalidity, uid, message_id) VALUES (?, ?, ?, ?, ?)",
+			(self.configuration, mailbox, uidvalidity, uid, message_id))
+		return db.execute("SELECT id FROM outbox_message WHERE configuration=? AND mailbox=? AND uidvalidity=? AND uid=?",
+			(self.configuration, mailbox, uidvalidity, uid)).fetchone()[0]
+
+	def add(self, key, name, content_type, data):
+		"""Legt den Anhang dauerhaft ab, erst danach ist er eingereiht."""
+		os.makedirs(self.directory, exist_ok=True)
+		fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+		try:
+			with os.fdopen(fd, "wb") as fp:
+				data.seek(0)
+				shutil.copyfileobj(data, fp)
+				fp.flush()
+				os.fsync(fp.fileno())
+
+			with self.transaction() as db:
+				message = self._message(db, key)
+				cursor = db.execute("INSERT INTO outbox_attachment (message, name, content_type, next_attempt) VALUES (?, ?, ?, ?)",
+					(message, name, content_type, time.time()))
+				path = os.path.join(self.directory, "{0:08d}".format(cursor.lastrowid))
+				os.replace(tmp_name, path)
+				db.execute("UPDATE outbox_attachment SET path=? WHERE id=?", (path, cursor.lastrowid))
+		except:
+			if os.path.exists(tmp_name):
+				os.unlink(tmp_name)
+			raise
+
+	def seal(self, key, message_id=None, failed=False):
+		with self.transaction() as db:
+			message = self._message(db, key, message_id)
+			db.execute("UPDATE outbox_message SET sealed=1, failed=?, message_id=? WHERE id=?", (int(failed), message_id, message))
+
+	def rollback_unsealed(self):
+		"""Entfernt Mails, die nie versiegelt wurden, weil der Prozess beim Einreihen
+		abgebrochen ist, samt ihrer Anhänge. Liefert deren (mailbox, uidvalidity, uid),
+		damit sie erneut bearbeitet werden. Nur aufrufen, solange dieser Prozess selbst
+		noch nichts eingereiht hat."""
+		with self.transaction() as db:
+			rows = db.execute("SELECT id, mailbox, uidvalidity, uid FROM outbox_message WHERE configuration=? AND NOT sealed",
+				(self.configuration, )).fetchall()
+			paths = []
+			for message, mailbox, uidvalidity, uid in rows:
+				paths.extend(path for (path, ) in db.execute("SELECT path FROM outbox_attachment WHERE message=?", (message, )))
+				db.execute("DELETE FROM outbox_attachment WHERE message=?", (message, ))
+				db.execute("DELETE FROM outbox_message WHERE id=?", (message, ))
+
+		for path in paths:
+			if path and os.path.exists(path):
+				os.unlink(path)
+
+		return [(mailbox, uidvalidity, uid) for (message, mailbox, uidvalidity, uid) in rows]
+
+	def claim(self, lease):
+		"""Reserviert den nächsten fälligen Anhang für lease Sekunden."""
+		now = time.time()
+		with self.transaction() as db:
+			row = db.execute("SELECT a.id, a.name, a.content_type, a.path, a.attempts FROM outbox_attachment a JOIN outbox_message m ON a.message=m.id "
+				"WHERE m.configuration=? AND a.state='pending' AND a.next_attempt<=? AND (a.claimed_until IS NULL OR a.claimed_until<?) "
+				"ORDER BY a.next_attempt LIMIT 1", (self.configuration, now, now)).fetchone()
+			if row is None:
+				return None
+			db.execute("UPDATE outbox_attachment SET claimed_until=? WHERE id=?", (now + lease, row[0]))
+			return OutboxEntry._make(row)
+
+	def finish(self, entry, failed=False, error=None):
+		self.db.execute("UPDATE outbox_attachment SET state=?, claimed_until=NULL, last_error=? WHERE id=?",
+			('failed' if failed else 'done', error, entry.id))
+		if os.path.exists(entry.path):
+			os.unlink(entry.path)
+
+	def retry(self, entry, delay, error=None):
+		self.db.execute("UPDATE outbox_attachment SET attempts=attempts+1, next_attempt=?, claimed_until=NULL, last_error=? WHERE id=?",
+			(time.time() + delay, error, entry.id))
+
+	def has_pending(self):
+		row = self.db.execute("SELECT 1 FROM outbox_message WHERE configuration=? LIMIT 1", (self.configuration, )).fetchone()
+		return row is not None
+
+	def completed(self, mailbox):
+		"""Liefert (id, uidvalidity, uid, message_id, erfolgreich) für alle erledigten Mails."""
+		rows = self.db.execute("SELECT m.id, m.uidvalidity, m.uid, m.message_id, m.failed, "
+			"SUM(a.state='pending'), SUM(a.state='failed') FROM outbox_message m LEFT JOIN outbox_attachment a ON a.message=m.id "
+			"WHERE m.configuration=? AND m.mailbox=? AND m.sealed GROUP BY m.id", (self.configuration, mailbox)).fetchall()
+
+		for message, uidvalidity, uid, message_id, failed, pending, attachments_failed in rows:
+			if not pending:
+				yield (message, uidvalidity, uid, message_id, not failed and not attachments_failed)
+
+	def forget(self, messages):
+		with self.transaction() as db:
+			for message in messages:
+				db.execute("DELETE FROM outbox_attachment WHERE message=?", (message, ))
+				db.execute("DELETE FROM outbox_message WHERE id=?", (message, ))
@@ -1,6 +1,7 @@
 import re
 import datetime
 import collections
+import bisect
 
 DOCUMENT_DIRECTORY = "Dokumente"
 CARD_DIRECTORY = "{card_no}"
@@ -8,6 +9,11 @@ CARD_CSV = "{card_no}.csv"
 CARD_STATEMENT_CSV = "{card_no}_{date}_Kreditkartenabrechnung.csv"
 CARD_STATEMENT_PDF = "{card_no}_{date}_Kreditkartenabrechnung.pdf"
 
+STATE_DIRECTORY = "Status"
+STATE_DATABASE = "lexofficetools.sqlite"
+OUTBOX_DIRECTORY = "Outbox"
+METRICS_DIRECTORY = "Metrics"
+
 def normalize_date_TTMMJJJJ(data):
 	data = "".join(data.split())
 	if not data:
@@ -45,6 +51,80 @@ def symmetric_difference(list_a, list_b, map_to_equiv=lambda x: x, transform_a=l
 
 	return only_in_a, only_in_b
 
+class MultisetIndex(object):
+	"""Bekannte Seite eines Vergleichs als Multimenge über key(item), wiederverwendbar für
+	beliebig viele neue Listen. Mit date(item) lässt sich der Vergleich auf ein Datumsfenster
+	beschränken, ohne die übrigen Einträge anzusehen."""
+	def __init__(self, items=(), key=lambda x: x, date=None):
+		self.key = key
+		self.date = date
+		self._counts = collections.Counter()
+		self._by_date = collections.defaultdict(list)
+		self._dates = []
+		for item in items:
+			self.add(item)
+
+	def __len__(self):
+		return sum(self._counts.values())
+
+	def add(self, item):
+		k = self.key(item)
+		item_date = self.date(item) if self.date else None
+		if item_date is not None and item_date not in self._by_date:
+			bisect.insort(self._dates, item_date)
+		self._by_date[item_date].append( (k, item) )
+		self._counts[k] += 1
+
+	def missing(self, items, key=None):
+		"""Liefert fortlaufend die Einträge aus items, die (in dieser Anzahl) nicht bekannt sind.
+		items wird nur einmal durchlaufen, der Aufwand hängt nicht von der Größe des Index ab."""
+		key = key or self.key
+		seen = collections.Counter()
+		for item in items:
+			k = key(item)
+			seen[k] += 1
+			if seen[k] > self._counts[k]:
+				yield item
+
+	def known(self, since=None, until=None):
+		"""Bekannte Einträge mit since <= date(item) <= until, ohne date oder Grenzen alle.
+		Einträge ohne Datum gehören nur ohne Grenzen dazu."""
+		if self.date is None or (since is None and until is None):
+			for entries in self._by_date.values():
+				yield from entries
+			return
+
+		start = 0 if since is None else bisect.bisect_left(self._dates, since)
+		end = len(self._dates) if until is None else bisect.bisect_right(self._dates, until)
+		for item_date in self._dates[start:end]:
+			yield from self._by_date[item_date]
+
+	def diff(self, items, key=None, since=None, until=None):
+		"""Wie symmetric_difference(items, bekannte): (nur in items, nur bekannt). Die bekannte
+		Seite wird dabei auf das Fenster since..until beschränkt."""
+		key = key or self.key
+		window = self._counts
+		if self.date is not None and (since is not None or until is not None):
+			window = collections.Counter(k for (k, item) in self.known(since, until))
+
+		only_in_items = []
+		matched = collections.Counter()
+		for item in items:
+			k = key(item)
+			if matched[k] < window[k]:
+				matched[k] += 1
+			else:
+				only_in_items.append(item)
+
+		only_known = []
+		for k, item in self.known(since, until):
+			if matched[k]:
+				matched[k] -= 1
+			else:
+				only_known.append(item)
+
+		return only_in_items, only_known
+
 
 class LoginError(Exception): pass
 
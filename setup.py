@@ -65,7 +65,10 @@ setup(
         'lxml',
     ],  # Optional
 
-    extras_require={},
+    extras_require={
+        'images': ['Pillow'],
+        'async': ['aiohttp'],
+    },
 
     package_data={},
 
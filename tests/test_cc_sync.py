@@ -0,0 +1,126 @@
+import random
+import unittest
+
+from lexofficetools.cc_sync import Account, AccountRegistry
+from lexofficetools.utils import CardNumber
+
+
+def linear_get(accounts, search):
+	## Die frühere lineare Suche aus FinancialAccountManager.get, nur ohne Kartenvergleich
+	## für Suchbegriffe ohne Ziffern (die passten dort als 'xxxxxxxxxxxxxxxx' auf jede Karte)
+	digits = isinstance(search, int) or (isinstance(search, str) and any(ch.isdigit() for ch in search))
+	for account in accounts:
+		if isinstance(search, CardNumber):
+			if account.card_no == search:
+				return account
+		else:
+			if account.financial_account_id == search:
+				return account
+			elif account.name == search:
+				return account
+			elif digits and account.card_no == search:
+				return account
+	return None
+
+def random_card(rng):
+	return "4277" + "".join(rng.choice("12") for i in range(8)) + rng.choice(["1234", "5678", "1299"])
+
+def masked_forms(card):
+	"""Schreibweisen derselben Karte mit unterschiedlich vielen bekannten Stellen."""
+	return [
+		card,
+		"{0} {1}xx xxxx {2}".format(card[:4], card[4:6], card[-4:]),
+		card[-4:],
+		"{0}*{1}".format(card[:6], card[-4:]),
+		card[:4] + "x",
+	]
+
+class AccountRegistryTest(unittest.TestCase):
+	def setUp(self):
+		self.rng = random.Random(1)
+
+	def make_registry(self, count):
+		registry = AccountRegistry()
+		cards = {}
+		for i in range(count):
+			card = random_card(self.rng)
+			account = Account(
+				financialAccountId=self.rng.choice([None, "id-{0}".format(self.rng.randrange(count))]),
+				name=self.rng.choice([None, "Kreditkarte", "Visa {0}".format(self.rng.randrange(count)), "Konto"]),
+				card_no=self.rng.choice([None] + masked_forms(card)),
+			)
+			registry.add(account)
+			cards[account] = card
+		return registry, cards
+
+	def searches(self, registry, cards):
+		for account in registry:
+			yield account.financial_account_id
+			yield account.name
+			for form in masked_forms(cards[account]):
+				yield form
+				yield CardNumber(form)
+			yield int(cards[account][-4:])
+		yield "unbekannt"
+		yield "id-unbekannt"
+		yield "9999"
+		yield CardNumber("9999")
+
+	def assertSameAsLinear(self, registry, cards):
+		accounts = list(registry)
+		for search in self.searches(registry, cards):
+			self.assertIs(registry.get(search), linear_get(accounts, search), search)
+
+	def test_get_matches_linear_scan(self):
+		for i in range(30):
+			registry, cards = self.make_registry(self.rng.randrange(1, 25))
+			self.assertSameAsLinear(registry, cards)
+
+	def test_insertion_order(self):
+		registry = AccountRegistry()
+		first = registry.add(Account(name="Visa", card_no="xxxx xxxx xxxx 1234"))
+		second = registry.add(Account(financialAccountId="Visa", card_no="4277 1912 1212 1234"))
+		wildcard = registry.add(Account(card_no="4277x"))
+
+		## Das zuerst hinzugefügte Konto gewinnt, egal über welchen Index es gefunden wird
+		self.assertIs(registry.get("Visa"), first)
+		self.assertIs(registry.get(CardNumber("1234")), first)
+		self.assertIs(registry.get("4277 1912 1212 1234"), first)
+		self.assertIs(registry.get(CardNumber("4277 1111 1111 5678")), wildcard)
+		self.assertIs(registry.get(CardNumber("5278x")), first)
+		self.assertIs(registry.get(None), first)
+		self.assertIs(registry.get("Kreditkarte"), None)
+
+	def test_reindex_after_update(self):
+		for i in range(30):
+			registry, cards = self.make_registry(self.rng.randrange(1, 25))
+			for account in list(registry):
+				choice = self.rng.randrange(4)
+				if choice == 0:
+					account.update(financialAccountId="id-neu-{0}".format(self.rng.randrange(5)))
+				elif choice == 1:
+					account.update(name=self.rng.choice([None, "Visa neu", "Konto"]))
+				elif choice == 2:
+					account.update(card_no=self.rng.choice(masked_forms(cards[account])))
+				elif account.card_no is not None:
+					## Füllt nur Platzhalter auf, ohne dass das Konto davon erfährt
+					account.card_no.update(cards[account])
+			self.assertSameAsLinear(registry, cards)
+
+	def test_reindex_removes_old_keys(self):
+		registry = AccountRegistry()
+		account = registry.add(Account(financialAccountId="alt", name="Alt", card_no="4277x"))
+
+		account.update(financialAccountId="neu", name="Neu", card_no="4277 1912 1212 1234")
+
+		self.assertIs(registry.get("alt"), None)
+		self.assertIs(registry.get("Alt"), None)
+		self.assertIs(registry.get("neu"), account)
+		self.assertIs(registry.get("Neu"), account)
+		self.assertIs(registry.get(CardNumber("5678")), None)
+		self.assertIs(registry.get(CardNumber("1234")), account)
+		self.assertEqual(len(registry), 1)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,55 @@
+import random
+import unittest
+
+from lexofficetools.utils import MultisetIndex, symmetric_difference
+
+
+def by_date(item):
+	return item[0]
+
+class MultisetIndexTest(unittest.TestCase):
+	def test_diff_matches_symmetric_difference(self):
+		rng = random.Random(1)
+		for i in range(500):
+			new = [(rng.randrange(6), rng.randrange(3)) for j in range(rng.randrange(15))]
+			known = [(rng.randrange(6), rng.randrange(3)) for j in range(rng.randrange(15))]
+
+			only_new, only_known = symmetric_difference(new, known)
+			index = MultisetIndex(known, date=by_date)
+
+			self.assertEqual(index.diff(new)[0], only_new)
+			self.assertEqual(sorted(index.diff(new)[1]), sorted(only_known))
+			self.assertEqual(list(index.missing(new)), only_new)
+
+	def test_duplicates(self):
+		index = MultisetIndex(["a", "a", "b"])
+
+		self.assertEqual(index.diff(["a", "a", "a", "b", "c"]), (["a", "c"], []))
+		self.assertEqual(index.diff(["a"]), ([], ["a", "b"]))
+		self.assertEqual(list(index.missing(["b", "b", "a", "a"])), ["b"])
+
+	def test_window(self):
+		known = [(1, "x"), (2, "y"), (3, "z"), (3, "z"), (5, "w")]
+		new = [(2, "y"), (3, "z"), (4, "v")]
+		index = MultisetIndex(known, date=by_date)
+
+		## Wie symmetric_difference auf den Einträgen im Fenster 2..4
+		in_window = lambda items: [item for item in items if 2 <= item[0] <= 4]
+		only_new, only_known = symmetric_difference(in_window(new), in_window(known))
+		self.assertEqual(index.diff(new, since=2, until=4), (only_new, only_known))
+		self.assertEqual(index.diff(new, since=2, until=4), ([(4, "v")], [(3, "z")]))
+
+		## Bekannte Einträge außerhalb des Fensters zählen nicht als Gegenstück
+		self.assertEqual(index.diff([(1, "x")], since=2), ([(1, "x")], [(2, "y"), (3, "z"), (3, "z"), (5, "w")]))
+
+	def test_key_and_add(self):
+		index = MultisetIndex(key=str.lower)
+		index.add("A")
+
+		self.assertEqual(len(index), 1)
+		self.assertEqual(index.diff(["a", "B"]), (["B"], []))
+		self.assertEqual(index.diff(["b"], key=str.upper), (["b"], ["A"]))
+
+
+if __name__ == '__main__':
+	unittest.main()